@@ -48,7 +48,7 @@
 
 # DBTITLE 1,RAG 구현이 필요로 되는 Python 패키지 설치
 !pip3 install -qqqq --upgrade pip
-!pip3 install -qqqq mlflow==2.10.1 lxml==4.9.3 transformers==4.34.0 langchain==0.1.20 beautifulsoup4==4.12.2 pymupdf4llm==0.0.10 aiohttp==3.10.0 gradio==4.0.0 #3.50.2
+!pip3 install -qqqq mlflow==2.10.1 lxml==4.9.3 transformers==4.34.0 langchain==0.1.20 beautifulsoup4==4.12.2 pymupdf==1.24.14 pymupdf4llm==0.0.10 aiohttp==3.10.0 gradio==4.0.0 #3.50.2
 !pip3 install -qqqq dbtunnel[gradio] databricks-vectorsearch==0.22 databricks-sdk databricks databricks-genai-inference
 dbutils.library.restartPython()
 
@@ -79,8 +79,30 @@ print(host)
 
 # COMMAND ----------
 
+# DBTITLE 1,(선택) 스키마 초기화
+# 스키마를 삭제하면 청크 테이블과 manifest 테이블이 비워져 모든 PDF를 다시 추출하고, 청크 id가 새로 발급되어 인덱스 전체를 다시 동기화합니다.
+# 실습 환경을 처음부터 다시 구성할 때에만 주석을 해제하여 실행하세요.
+# spark.sql(f"DROP DATABASE IF EXISTS `{catalog}`.`{dbName}` CASCADE")
+
+# COMMAND ----------
+
 # DBTITLE 1,Helper 함수 초기화
-# MAGIC %run ./init-script $reset_all_data=true
+# MAGIC %run ./init-script $reset_all_data=false
+
+# COMMAND ----------
+
+# DBTITLE 1,PDF 전처리 Helper 함수 초기화
+# MAGIC %run ./ingest-helpers
+
+# COMMAND ----------
+
+# DBTITLE 1,임베딩 Helper 함수 초기화
+# MAGIC %run ./embedding-helpers
+
+# COMMAND ----------
+
+# DBTITLE 1,검색 Helper 함수 초기화
+# MAGIC %run ./retrieval-helpers
 
 # COMMAND ----------
 
@@ -211,12 +233,14 @@ print(response.text)
 import mlflow.deployments
 deploy_client = mlflow.deployments.get_deploy_client("databricks")
 
-if embedding_model_name in [endpoints['name'] for endpoints in deploy_client.list_endpoints()]:    
+existing_endpoints = [endpoints['name'] for endpoints in call_with_retry("serving-endpoints", deploy_client.list_endpoints)]
+
+if embedding_model_name in existing_endpoints:    
     #deploy_client.delete_endpoint(embedding_model_name)
     print("동일한 모델의 엔드포인트가 이미 존재합니다.")
 
-if embedding_model_name not in [endpoints['name'] for endpoints in deploy_client.list_endpoints()]:    
-    deploy_client.create_endpoint(
+if embedding_model_name not in existing_endpoints:    
+    create_with_retry("serving-endpoints", deploy_client.create_endpoint,
         name=embedding_model_name,
         config={
             "served_entities": [
@@ -245,13 +269,15 @@ if embedding_model_name not in [endpoints['name'] for endpoints in deploy_client
 import mlflow.deployments
 deploy_client = mlflow.deployments.get_deploy_client("databricks")
 
-if generative_model_name in [endpoints['name'] for endpoints in deploy_client.list_endpoints()]:    
+existing_endpoints = [endpoints['name'] for endpoints in call_with_retry("serving-endpoints", deploy_client.list_endpoints)]
+
+if generative_model_name in existing_endpoints:    
     #deploy_client.delete_endpoint(generative_model_name)
     print("동일한 모델의 엔드포인트가 이미 존재합니다.")
 
 # claude-3-5-sonnet-20240620-v1:0, claude-3-sonnet-20240229-v1:0
-if generative_model_name not in [endpoints['name'] for endpoints in deploy_client.list_endpoints()]:    
-    deploy_client.create_endpoint(
+if generative_model_name not in existing_endpoints:    
+    create_with_retry("serving-endpoints", deploy_client.create_endpoint,
         name=generative_model_name,
         config={
             "served_entities": [
@@ -276,10 +302,11 @@ if generative_model_name not in [endpoints['name'] for endpoints in deploy_clien
 
 # COMMAND ----------
 
-# DBTITLE 1,위 엔드포인트 배포의 안정성을 위해 약간의 시간을 대기
-# 모델 배포가 완료되기까지 5분 정도 기다립니다.
-import time
-time.sleep(300)
+# DBTITLE 1,위 엔드포인트가 준비될 때까지 대기
+# 고정된 시간 대신 두 엔드포인트의 상태를 확인하여 준비되는 즉시 다음 단계로 진행합니다.
+for endpoint_name in [embedding_model_name, generative_model_name]:
+    wait_for_model_serving_endpoint_to_be_ready(deploy_client, endpoint_name)
+    print(f"모델 서빙 엔드포인트 {endpoint_name} 가 준비 되었습니다.")
 
 # COMMAND ----------
 
@@ -335,20 +362,54 @@ time.sleep(300)
 import pymupdf4llm
 from langchain.text_splitter import MarkdownTextSplitter
 
-md_text = pymupdf4llm.to_markdown(doc="./krpdf.pdf"
-                                  ,pages=list(range(5, 20))                              
-                                  ,write_images=False
-                                  ,margins=(20, 60, 20, 60) # 왼쪽, 위쪽, 오른쪽, 아래
-                                  ,table_strategy='lines_strict'
-                                  ,page_chunks=False
-                                  #,graphics_limit=20
-                                  ) 
+# True로 설정하면 괘선이 교차하는 페이지에서만 표를 감지하고 텍스트 전용 페이지는 표 감지를 생략합니다.
+# (ingest-helpers 노트북의 to_markdown_adaptive, 추출 결과는 같으며 벤치마크 노트북에서 페이지당 절감 시간 비교)
+adaptive_tables = False
+extract_markdown = to_markdown_adaptive if adaptive_tables else pymupdf4llm.to_markdown
+
+with span("extract", doc="./krpdf.pdf", pages=15, adaptive_tables=adaptive_tables) as record:
+    md_text = extract_markdown(doc="./krpdf.pdf"
+                               ,pages=list(range(5, 20))                              
+                               ,write_images=False
+                               ,margins=(20, 60, 20, 60) # 왼쪽, 위쪽, 오른쪽, 아래
+                               ,table_strategy='lines_strict'
+                               ,page_chunks=False
+                               #,graphics_limit=20
+                               ) 
+    record["bytes"] = len(md_text.encode("utf-8"))
 
 
 print(md_text)
 
 # COMMAND ----------
 
+# DBTITLE 1,(선택) 페이지를 나누어 여러 프로세스로 병렬 추출
+# 300페이지 이상의 큰 문서는 아래 주석을 해제하면 페이지 목록을 여러 프로세스로 나누어 추출합니다.
+# 각 샤드는 동일한 margins와 table_strategy로 추출되고 페이지 순서대로 결합되므로 결과는 위의 단일 호출과 같습니다.
+# md_text = to_markdown_parallel(doc="./krpdf.pdf"
+#                                ,pages=list(range(5, 20))
+#                                ,write_images=False
+#                                ,margins=(20, 60, 20, 60) # 왼쪽, 위쪽, 오른쪽, 아래
+#                                ,table_strategy='lines_strict'
+#                                ,page_chunks=False
+#                                )
+
+# COMMAND ----------
+
+# DBTITLE 1,(선택) 추출 결과를 페이지 단위로 캐시하여 재실행 시 추출을 생략
+# PDF와 추출 파라미터가 같다면 재실행 시 캐시된 페이지를 사용하고, 페이지 범위가 바뀌면 캐시에 없는 페이지만 추출합니다.
+# md_cache = MarkdownPageCache("./.md_cache", max_bytes=512 * 1024 * 1024)
+# md_text = to_markdown_cached(doc="./krpdf.pdf"
+#                              ,pages=list(range(5, 20))
+#                              ,cache=md_cache
+#                              ,write_images=False
+#                              ,margins=(20, 60, 20, 60) # 왼쪽, 위쪽, 오른쪽, 아래
+#                              ,table_strategy='lines_strict'
+#                              )
+# print(md_cache.stats())
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## 레이아웃 손상으로 발생한 에러 메시지를 제거
 
@@ -367,7 +428,9 @@ def remove_syntax_error_lines(text):
     return cleaned_text
 
 # "syntax error"가 포함된 줄을 제거하는 함수 호출
-md_text_temp = remove_syntax_error_lines(md_text)
+with span("cleanup.remove_syntax_error_lines") as record:
+    md_text_temp = remove_syntax_error_lines(md_text)
+    record["bytes"] = len(md_text_temp.encode("utf-8"))
 
 print(md_text_temp)
 
@@ -394,17 +457,14 @@ def remove_footnotes_and_references(text):
     # 페이지별로 텍스트 분할
     pages = page_split_pattern.split(text)
     
-    # 각 페이지에서 각주 내용을 제거하는 패턴 정의
-    footnote_pattern = re.compile(r'\d+\) .*(\n.*)*')
-    
     # 본문 내의 각주 참조 제거 패턴 정의
     reference_pattern = re.compile(r'\[\d+\)\]')
     
     cleaned_pages = []
     
     for page in pages:
-        # 각주 내용을 제거
-        cleaned_page = re.sub(footnote_pattern, '', page).strip()
+        # 처음 나오는 '숫자) ' 각주부터 페이지 끝까지를 선형 시간에 제거 (ingest-helpers 노트북의 cut_footnotes)
+        cleaned_page = cut_footnotes(page).strip()
         # 본문 내의 각주 참조 제거
         cleaned_page = re.sub(reference_pattern, '', cleaned_page).strip()
         cleaned_pages.append(cleaned_page)
@@ -416,7 +476,9 @@ def remove_footnotes_and_references(text):
 
 
 # 각 페이지의 각주 내용을 제거하는 함수 호출
-md_text_temp = remove_footnotes_and_references(md_text_temp)
+with span("cleanup.remove_footnotes_and_references") as record:
+    md_text_temp = remove_footnotes_and_references(md_text_temp)
+    record["bytes"] = len(md_text_temp.encode("utf-8"))
 
 print(md_text_temp)
 
@@ -436,17 +498,19 @@ print(md_text_temp)
 # DBTITLE 1,문서의 컨텐츠를 마크다운 대/중/소로 분류
 import re
 
-# ''을 ' '로 변경
-md_text_temp = re.sub(r'', ' ', md_text_temp)
+with span("cleanup.headers") as record:
+    # ''을 ' '로 변경
+    md_text_temp = re.sub(r'', ' ', md_text_temp)
 
-# '####'을 '# '로 변경
-md_text_temp = re.sub(r'####', '#', md_text_temp)
+    # '####'을 '# '로 변경
+    md_text_temp = re.sub(r'####', '#', md_text_temp)
 
-# 숫자. 으로 시작하는 항목을 ## 숫자. 으로 변경
-md_text_temp = re.sub(r'^(\d+)\. ', r'## \1. ', md_text_temp, flags=re.MULTILINE)
+    # 숫자. 으로 시작하는 항목을 ## 숫자. 으로 변경
+    md_text_temp = re.sub(r'^(\d+)\. ', r'## \1. ', md_text_temp, flags=re.MULTILINE)
 
-# '□'으로 시작하는 문장을 ### 으로 변경
-md_text_temp = re.sub(r'^□', r'### ', md_text_temp, flags=re.MULTILINE)
+    # '□'으로 시작하는 문장을 ### 으로 변경
+    md_text_temp = re.sub(r'^□', r'### ', md_text_temp, flags=re.MULTILINE)
+    record["bytes"] = len(md_text_temp.encode("utf-8"))
 
 print(md_text_temp)
 
@@ -461,11 +525,13 @@ print(md_text_temp)
 # DBTITLE 1,마크다운언어가 이해하지 못하는 특수기호 제거
 import re
 
-md_text_temp = re.sub(r'ㅇ', '- ', md_text_temp)
-md_text_temp = re.sub(r'→', ' 에서 ', md_text_temp)
-md_text_temp = re.sub(r'’', '20', md_text_temp)
-md_text_temp = re.sub(r'☞', '- ', md_text_temp)
-md_text_temp = re.sub(r'[\*\*\[\]▲「」]', '', md_text_temp)
+with span("cleanup.symbols") as record:
+    md_text_temp = re.sub(r'ㅇ', '- ', md_text_temp)
+    md_text_temp = re.sub(r'→', ' 에서 ', md_text_temp)
+    md_text_temp = re.sub(r'’', '20', md_text_temp)
+    md_text_temp = re.sub(r'☞', '- ', md_text_temp)
+    md_text_temp = re.sub(r'[\*\*\[\]▲「」]', '', md_text_temp)
+    record["bytes"] = len(md_text_temp.encode("utf-8"))
 
 print(md_text_temp)
 
@@ -484,8 +550,10 @@ print(md_text_temp)
 # DBTITLE 1,모든 문서의 인용 구문 삭제
 import re
 
-# 괄호 안에 쉼표가 있는 경우 괄호와 그 안의 내용을 모두 삭제
-md_text_temp = re.sub(r'\([^()]*,[^()]*\)', '', md_text_temp)
+with span("cleanup.citations") as record:
+    # 괄호 안에 쉼표가 있는 경우 괄호와 그 안의 내용을 모두 삭제
+    md_text_temp = re.sub(r'\([^()]*,[^()]*\)', '', md_text_temp)
+    record["bytes"] = len(md_text_temp.encode("utf-8"))
 
 print(md_text_temp)
 
@@ -505,36 +573,46 @@ print(md_text_temp)
 # DBTITLE 1,문서의 표를 마크다운으로 추출하고 레이아웃 정리
 import re
 
-# '-----' 기호를 ''로 치환
-md_text_temp = re.sub(r'-----', '', md_text_temp)
+with span("cleanup.layout") as record:
+    # '-----' 기호를 ''로 치환
+    md_text_temp = re.sub(r'-----', '', md_text_temp)
 
-# 모든 개행 삭제
-md_text_temp = md_text_temp.replace('\n\n', '')
+    # 모든 개행 삭제
+    md_text_temp = md_text_temp.replace('\n\n', '')
 
-# 이중 공백 삭제
-md_text_temp = md_text_temp.replace('  ', ' ')
+    # 이중 공백 삭제
+    md_text_temp = md_text_temp.replace('  ', ' ')
 
-# '#'가 등장하면 앞에 개행을 추가
-md_text_temp = re.sub(r'(#+)', r'\n\n\1', md_text_temp)
+    # '#'가 등장하면 앞에 개행을 추가
+    md_text_temp = re.sub(r'(#+)', r'\n\n\1', md_text_temp)
 
-# 'C'와 '#' 사이의 개행이나 공백을 제거
-md_text_temp = re.sub(r'C\s*#', r'C#', md_text_temp)
+    # 'C'와 '#' 사이의 개행이나 공백을 제거
+    md_text_temp = re.sub(r'C\s*#', r'C#', md_text_temp)
 
-# '-'가 등장하면 앞에 개행을 추가
-# '-' 다음에 공백이 아닌 문자가 오는 경우에만 새로운 줄로 분리
-# 즉, '-' 뒤에 공백이 오면 항목 구분자로 처리하지 않음
-md_text_temp = re.sub(r'- (?=\S)', r'\n\n- ', md_text_temp.strip())
+    # '-'가 등장하면 앞에 개행을 추가
+    # '-' 다음에 공백이 아닌 문자가 오는 경우에만 새로운 줄로 분리
+    # 즉, '-' 뒤에 공백이 오면 항목 구분자로 처리하지 않음
+    md_text_temp = re.sub(r'- (?=\S)', r'\n\n- ', md_text_temp.strip())
 
-# '표' 앞에 두 번 개행 추가
-md_text_temp = re.sub(r'(표 \d)', r'\n\n\1', md_text_temp)
-# '표 2', '표 3', '표 4' 다음에 '|' 앞에서 두 번 개행 추가
-md_text_temp = re.sub(r'(표 \d.*?)(\|)', r'\1\n\n\2', md_text_temp)
+    # '표' 앞에 두 번 개행 추가
+    md_text_temp = re.sub(r'(표 \d)', r'\n\n\1', md_text_temp)
+    # '표 2', '표 3', '표 4' 다음에 '|' 앞에서 두 번 개행 추가
+    md_text_temp = re.sub(r'(표 \d.*?)(\|)', r'\1\n\n\2', md_text_temp)
 
-# '※'로 시작하는 문장과 그 후에 오는 관련 내용을 제거
-md_text_temp = re.sub(r'※[^­]*­', '\n', md_text_temp, flags=re.DOTALL)
+    # '※'로 시작하는 문장과 그 후에 오는 관련 내용을 제거
+    md_text_temp = re.sub(r'※[^­]*­', '\n', md_text_temp, flags=re.DOTALL)
+    record["bytes"] = len(md_text_temp.encode("utf-8"))
 
 print(md_text_temp)
 
+# COMMAND ----------
+
+# DBTITLE 1,(선택) 위의 정제 단계를 규칙 엔진으로 한 번에 적용
+# ingest-helpers 노트북의 NORMALIZATION_RULES는 위의 정제 셀들을 선언적으로 정의한 규칙입니다.
+# 고정 문자열 치환은 str.replace로, 정규식은 미리 컴파일하여 적용하며 결과는 위의 셀들과 동일합니다.
+# 정제 전체를 한 번 더 수행하므로 기본으로는 실행하지 않으며, 규칙을 수정한 경우에만 주석을 해제하여 결과를 확인하세요.
+# assert normalize_markdown(md_text) == md_text_temp
+
 
 # COMMAND ----------
 
@@ -579,7 +657,16 @@ headers_to_split_on = [
 markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on)
 
 # 텍스트를 헤더를 기준으로 청크로 분할하여 리스트 객체로 저장
-md_header_splits = markdown_splitter.split_text(md_text_temp)
+with span("chunking.split_text") as record:
+    md_header_splits = markdown_splitter.split_text(md_text_temp)
+    record["bytes"] = len(md_text_temp.encode("utf-8"))
+    record["items"] = len(md_header_splits)
+
+# 헤더 사이의 내용이 너무 긴 청크는 임베딩 모델의 입력 한도와 프롬프트 크기를 넘지 않도록 토큰 수 상한에 맞추어 다시 분할
+# 다시 분할된 청크는 앞 청크와 overlap_tokens만큼 겹치며 원래 청크의 헤더 정보를 그대로 유지합니다.
+with span("chunking.split_by_token_budget") as record:
+    md_header_splits = split_by_token_budget(md_header_splits, max_tokens=1000, overlap_tokens=100)
+    record["items"] = len(md_header_splits)
 
 # 청크를 출력하여 확인
 for chunk in md_header_splits:
@@ -588,6 +675,41 @@ for chunk in md_header_splits:
 
 # COMMAND ----------
 
+# DBTITLE 1,임베딩 전에 유사 중복 청크 제거
+# 반복되는 표 제목이나 상용구처럼 내용이 거의 같은 청크는 임베딩 호출을 낭비하고 검색 결과의 상위 자리를 차지하므로 MinHash/LSH로 제거합니다.
+# threshold는 두 청크의 문자 n-gram Jaccard 유사도 기준이며, 유사한 청크 묶음에서 첫 번째 청크만 남깁니다.
+with span("chunking.dedup_chunks") as record:
+    md_header_splits, dedup_stats = dedup_chunks(md_header_splits, threshold=0.9)
+    record["items"] = len(md_header_splits)
+print(f"유사 중복 청크 {dedup_stats['dropped']}개를 제거하여 임베딩 호출 {dedup_stats['embedding_calls_saved']}회를 절약했습니다.")
+
+# COMMAND ----------
+
+# DBTITLE 1,(선택) 여러 문서를 페이지 단위로 스트리밍하여 청킹
+# 수천 개의 문서를 처리할 때는 문서 전체를 하나의 문자열로 유지하지 않고, 한 페이지씩 추출, 정제, 헤더 식별, 청킹을 수행합니다.
+# 메모리에는 한 페이지만 유지되며, 페이지를 넘어 이어지는 섹션은 이전 페이지의 상위 헤더를 이어받습니다.
+# for chunk in stream_document_chunks("./krpdf.pdf"
+#                                     ,pages=range(5, 20)
+#                                     ,write_images=False
+#                                     ,margins=(20, 60, 20, 60) # 왼쪽, 위쪽, 오른쪽, 아래
+#                                     ,table_strategy='lines_strict'
+#                                     ):
+#   print(chunk.metadata)
+
+# COMMAND ----------
+
+# DBTITLE 1,(선택) Spark Executor에서 여러 PDF 문서를 분산 처리하여 청킹
+# 디렉터리 또는 Volume의 PDF를 binaryFile로 읽고, 각 파티션에서 추출, 정제, 청킹을 수행하여 청크 DataFrame을 만듭니다.
+# Executor 수에 따라 처리량이 늘어나며, 결과는 databricks_documentation 테이블에 추가할 수 있는 형태입니다.
+# chunks_df = extract_pdf_chunks(read_pdf_files(f"/Volumes/{uc_catalog}/{uc_schema}/pdf")
+#                                ,write_images=False
+#                                ,margins=(20, 60, 20, 60) # 왼쪽, 위쪽, 오른쪽, 아래
+#                                ,table_strategy='lines_strict'
+#                                )
+# chunks_df.display()
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## 청크정보를 임베딩하여 벡터값을 구한 뒤 델타 테이블에 저장
 
@@ -595,24 +717,32 @@ for chunk in md_header_splits:
 
 # DBTITLE 1,청크 정보를 저장할 델타 테이블을 생성
 spark.sql(f"""
-CREATE OR REPLACE TABLE {uc_catalog}.{uc_schema}.databricks_documentation (
+CREATE TABLE IF NOT EXISTS {uc_catalog}.{uc_schema}.databricks_documentation (
   id BIGINT GENERATED BY DEFAULT AS IDENTITY
   ,created_at TIMESTAMP
   ,content STRING
+  ,header_1 STRING
+  ,header_2 STRING
+  ,header_3 STRING
+  ,source STRING
+  ,page INT
+  ,chunk_hash STRING
+  ,embedding ARRAY<FLOAT>
 ) TBLPROPERTIES (delta.enableChangeDataFeed = true)
 """).display()
 
+# 이전 버전의 노트북으로 만든 테이블이 남아 있으면 CREATE TABLE IF NOT EXISTS는 아무것도 바꾸지 않으므로, 빠진 컬럼을 추가합니다.
+migrate_chunk_table(f"{uc_catalog}.{uc_schema}.databricks_documentation")
+
 # COMMAND ----------
 
 # DBTITLE 1,테이블에 청크 정보를 저장
-import json
-
-for chunk in md_header_splits:
-  json_chunk = json.dumps(chunk.to_json()).replace("'", "''")
-  spark.sql(f"""
-            INSERT INTO {uc_catalog}.{uc_schema}.databricks_documentation(content, created_at)
-            VALUES('{json_chunk}', from_utc_timestamp(current_timestamp(), 'UTC+9'))
-            """)
+# 청크마다 INSERT 문을 실행하면 청크 수만큼 델타 커밋과 작은 파일이 생기므로, 모든 청크를 하나의 DataFrame으로 만들어 한 번에 반영합니다.
+# content에는 LangChain 직렬화 정보 없이 본문만 저장하고, 헤더와 출처는 별도 컬럼에 저장하여 임베딩과 프롬프트의 토큰을 줄입니다.
+# 청크는 출처, 헤더 경로, 본문의 해시를 키로 MERGE되므로 다시 실행해도 변경되지 않은 청크는 id가 유지되고 새로운 청크만 임베딩됩니다.
+with span("delta.merge", table="databricks_documentation") as record:
+  upsert_chunks(chunks_to_dataframe(md_header_splits, source="./krpdf.pdf"), f"{uc_catalog}.{uc_schema}.databricks_documentation", sources=["./krpdf.pdf"])
+  record["items"] = len(md_header_splits)
 
 spark.sql(f"""
           SELECT * FROM {uc_catalog}.{uc_schema}.databricks_documentation ORDER BY id
@@ -620,30 +750,39 @@ spark.sql(f"""
 
 # COMMAND ----------
 
-# DBTITLE 1,Vector Store에 저장하기전 임베딩 모델 테스트
-import time
-time.sleep(60)
+# DBTITLE 1,(선택) 새로 추가되거나 변경된 PDF만 증분 처리
+# 처리한 파일의 경로, 크기, 수정 시각, 내용 해시를 manifest 테이블에 기록하고, 새로 추가되거나 변경된 PDF만 처리합니다.
+# 삭제된 PDF의 청크는 테이블에서 회수되므로, 야간 배치에서는 변경분만 처리하게 됩니다.
+# manifest 테이블은 실행 간에 유지되어야 하므로 스키마 초기화 셀을 실행하지 않는 한 두 번째 실행부터는 변경되지 않은 PDF가 unchanged로 집계되고 다시 추출되지 않습니다.
+# ingest_stats = ingest_pdfs_incremental(f"/Volumes/{uc_catalog}/{uc_schema}/pdf"
+#                                        ,target_table=f"{uc_catalog}.{uc_schema}.databricks_documentation"
+#                                        ,manifest_table=f"{uc_catalog}.{uc_schema}.pdf_ingest_manifest"
+#                                        ,write_images=False
+#                                        ,margins=(20, 60, 20, 60) # 왼쪽, 위쪽, 오른쪽, 아래
+#                                        ,table_strategy='lines_strict'
+#                                        )
+# print(ingest_stats)
+
+# COMMAND ----------
 
+# DBTITLE 1,Vector Store에 저장하기전 임베딩 모델 테스트
 import mlflow.deployments
 deploy_client = mlflow.deployments.get_deploy_client("databricks")
 
-response = deploy_client.predict(endpoint=embedding_model_name, inputs={"input": ["Enlgish embedding Test."]})
-embeddings = [e['embedding'] for e in response.data]
-print(embeddings)
-
-time.sleep(60)
-
-response = deploy_client.predict(endpoint=embedding_model_name, inputs={"input": ["한국어 임베딩 테스트 입니다."]})
-embeddings = [e['embedding'] for e in response.data]
-print(embeddings)
-
-time.sleep(60)
-
-response = deploy_client.predict(endpoint=embedding_model_name, inputs={"input": ["Databricks와 AWS가 함께하는 Zero to GenAI."]})
-embeddings = [e['embedding'] for e in response.data]
-print(embeddings)
+# 테스트 문장을 한 번의 배치 요청으로 묶어 호출하며, 요청 간격은 고정된 대기 대신 토큰 버킷으로 제한합니다.
+# 이미 임베딩한 텍스트는 모델 이름과 텍스트 해시를 키로 캐시에서 가져오므로 다시 실행해도 엔드포인트를 호출하지 않습니다.
+# dtype="float16" 또는 "int8"로 지정하면 캐시의 벡터를 각각 1/2, 1/4 크기로 양자화하여 저장합니다. (벤치마크 노트북에서 recall@k 비교)
+embedding_cache = EmbeddingCache(embedding_model_name, path="./.embedding_cache.sqlite")
+embedding_client = BatchEmbeddingClient(embedding_model_name, host, token=databricks_token, max_batch_size=16, max_concurrency=4, requests_per_second=1.0, cache=embedding_cache)
+test_sentences = ["Enlgish embedding Test.", "한국어 임베딩 테스트 입니다.", "Databricks와 AWS가 함께하는 Zero to GenAI."]
 
-time.sleep(60)
+with span("embedding.predict", endpoint=embedding_model_name) as record:
+  embeddings = embedding_client.embed(test_sentences)
+  record["items"] = len(test_sentences)
+for sentence, embedding in zip(test_sentences, embeddings):
+  print(f"{sentence} : {embedding[:5]}...")
+print(embedding_client.last_stats)
+print(embedding_cache.stats())
 
 # COMMAND ----------
 
@@ -668,7 +807,7 @@ from databricks.vector_search.client import VectorSearchClient
 vsc = VectorSearchClient()
 
 if not endpoint_exists(vsc, vector_search_endpoint_name):
-    vsc.create_endpoint(name=vector_search_endpoint_name, endpoint_type="STANDARD")
+    create_with_retry(vector_search_endpoint_name, vsc.create_endpoint, name=vector_search_endpoint_name, endpoint_type="STANDARD")
 
 print("Vector Search 엔드포인트를 배포합니다. 이 작업은 10~15분 정도 소요됩니다.")
 wait_for_vs_endpoint_to_be_ready(vsc, vector_search_endpoint_name)
@@ -685,23 +824,46 @@ source_table_fullname = f"{uc_catalog}.{uc_schema}.databricks_documentation"
 # 인덱스를 저장할 위치
 vs_index_fullname = f"{uc_catalog}.{uc_schema}.databricks_documentation_vs_index"
 
+# True로 설정하면 자체 관리 임베딩 모드로 동작합니다.
+# Spark Executor에서 embedding 컬럼이 비어 있는 청크만 배치로 임베딩하여 테이블에 저장하고, 인덱스는 저장된 벡터를 그대로 사용합니다.
+# 인덱스 유형은 생성 시에 정해지므로, 모드를 바꾸려면 기존 인덱스를 삭제한 뒤 다시 생성해야 합니다.
+self_managed_embeddings = False
+
+if self_managed_embeddings:
+  with span("embedding.spark_udf", table=source_table_fullname) as record:
+    record["items"] = embed_missing_chunks(source_table_fullname, embedding_model_name, host, token=databricks_token,
+                                           requests_per_second=4.0, num_partitions=4, max_batch_size=16)
+
 if not index_exists(vsc, vector_search_endpoint_name, vs_index_fullname):
   print(f"Vector Search 인덱스 {vs_index_fullname} 를 Vector Search 엔드포인트 {vector_search_endpoint_name} 에 생성 중입니다. 이 작업은 5~10분 정도 소요됩니다.")
-  vsc.create_delta_sync_index(
-    endpoint_name=vector_search_endpoint_name,
-    index_name=vs_index_fullname,
-    source_table_name=source_table_fullname,
-    pipeline_type="TRIGGERED",
-    primary_key="id",
-    embedding_source_column='content', # 텍스트가 포함된 컬럼
-    embedding_model_endpoint_name=embedding_model_name # 임베딩을 만드는 데 사용된 임베딩 엔드포인트
-  )
+  if self_managed_embeddings:
+    create_with_retry(vector_search_endpoint_name, vsc.create_delta_sync_index,
+      endpoint_name=vector_search_endpoint_name,
+      index_name=vs_index_fullname,
+      source_table_name=source_table_fullname,
+      pipeline_type="TRIGGERED",
+      primary_key="id",
+      embedding_dimension=1536, # Titan embed g1 모델의 벡터 차원
+      embedding_vector_column="embedding" # 미리 계산한 벡터가 포함된 컬럼
+    )
+  else:
+    create_with_retry(vector_search_endpoint_name, vsc.create_delta_sync_index,
+      endpoint_name=vector_search_endpoint_name,
+      index_name=vs_index_fullname,
+      source_table_name=source_table_fullname,
+      pipeline_type="TRIGGERED",
+      primary_key="id",
+      embedding_source_column='content', # 텍스트가 포함된 컬럼
+      embedding_model_endpoint_name=embedding_model_name # 임베딩을 만드는 데 사용된 임베딩 엔드포인트
+    )
   # 인덱스가 준비되고 모든 임베딩이 생성되고 인덱싱될 때까지 대기
-  wait_for_index_to_be_ready(vsc, vector_search_endpoint_name, vs_index_fullname)
+  with span("vector_search.wait_for_index_to_be_ready", index=vs_index_fullname):
+    wait_for_index_to_be_ready(vsc, vector_search_endpoint_name, vs_index_fullname)
 else:
   # 동기화를 트리거하여 테이블에 저장된 새 데이터로 벡터 검색 콘텐츠를 업데이트
-  wait_for_index_to_be_ready(vsc, vector_search_endpoint_name, vs_index_fullname)
-  vsc.get_index(vector_search_endpoint_name, vs_index_fullname).sync()
+  with span("vector_search.wait_for_index_to_be_ready", index=vs_index_fullname):
+    wait_for_index_to_be_ready(vsc, vector_search_endpoint_name, vs_index_fullname)
+  call_with_retry(vector_search_endpoint_name, lambda: vsc.get_index(vector_search_endpoint_name, vs_index_fullname).sync())
 
 print(f"index {vs_index_fullname} on table {source_table_fullname} is ready")
 
@@ -724,16 +886,51 @@ deploy_client = mlflow.deployments.get_deploy_client("databricks")
 
 question = "SW융합산업에서 자동차 산업의 경우 구직자의 근무지는 주로 어디인가요?"
 
-results = vsc.get_index(vector_search_endpoint_name, vs_index_fullname).similarity_search(
-  query_text=question,
-  columns=["created_at", "content"],
-  num_results=4
-)
-docs = results.get('result', {}).get('data_array', [])
+# 자체 관리 임베딩 인덱스는 질문도 직접 임베딩하여 벡터로 검색합니다.
+query = {"query_vector": embedding_client.embed([question])[0]} if self_managed_embeddings else {"query_text": question}
+
+with span("vector_search.similarity_search", num_results=4) as record:
+  results = call_with_retry(vector_search_endpoint_name, lambda: vsc.get_index(vector_search_endpoint_name, vs_index_fullname).similarity_search(
+    **query,
+    columns=["created_at", "header_1", "header_2", "content"],
+    num_results=4
+  ))
+  docs = results.get('result', {}).get('data_array', [])
+  record["items"] = len(docs)
 docs
 
 # COMMAND ----------
 
+# DBTITLE 1,(선택) 델타 테이블과 임베딩으로 로컬 벡터 인덱스를 만들어 네트워크 왕복 없이 검색
+# 청크 테이블과 임베딩(자체 관리 임베딩 모드의 embedding 컬럼 또는 임베딩 클라이언트)으로 IVF 인덱스를 만들어 디스크에 저장합니다.
+# 인덱스는 메모리 매핑으로 로드되며 Vector Search 인덱스와 같은 형식의 similarity_search 응답을 반환하므로,
+# 오프라인 검색이나 모델 서빙 컨테이너 안의 저지연 복제본으로 사용할 수 있습니다. (모델 서빙에서 사용하려면 Volume 경로에 저장)
+# nprobe를 지정하지 않으면 모든 벡터를 정확히 탐색하며, 청크가 많아 근사 탐색이 필요하면 tune_nprobe로 목표 recall에 맞는 nprobe를 정합니다.
+# from langchain_community.embeddings import DatabricksEmbeddings
+# local_index = LocalVectorIndex.from_table(source_table_fullname, "./local_vector_index"
+#                                           ,embed_documents=embedding_client.embed
+#                                           ,embed_query=DatabricksEmbeddings(endpoint=embedding_model_name).embed_query
+#                                           ,dtype="float16"
+#                                           )
+# with span("local_index.similarity_search", num_results=4) as record:
+#   local_results = local_index.similarity_search(query_text=question, columns=["created_at", "header_1", "header_2", "content"]
+#                                                 ,filters={"header_1 NOT": None}, num_results=4)
+#   record["items"] = local_results["result"]["row_count"]
+# local_results["result"]["data_array"]
+
+# COMMAND ----------
+
+# DBTITLE 1,(선택) 여러 질문의 관련 청크를 한 번에 검색
+# 평가나 일괄 질의응답에서는 질문을 하나씩 검색하는 대신, 질문 임베딩을 한 번에 계산하고 블록 단위 행렬 곱으로 모든 질문의 상위 k개 청크를 구합니다.
+# evaluation_questions = [question, "자동차 기업인 General Motors의 경우 Microsoft와 협력해 개발중인 생성형AI 서비스는?"]
+# with span("local_index.batch_search", num_results=4) as record:
+#   chunk_ids, chunk_scores = local_index.batch_search(embedding_client.embed(evaluation_questions), num_results=4)
+#   record["items"] = len(evaluation_questions)
+# for evaluation_question, ids, scores in zip(evaluation_questions, chunk_ids, chunk_scores):
+#   print(evaluation_question, list(zip(ids, scores.round(3))))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC # 5. 검색 증강 생성(RAG) 및 Amazon Bedrock과 연계하여 챗봇 생성하기
 # MAGIC
@@ -791,9 +988,19 @@ from langchain_community.embeddings import DatabricksEmbeddings
 
 # 랭체인 모델 임베딩 테스트
 # 참고: 질문 임베딩 모델은 이전 모델의 Chunk에 사용된 모델과 일치해야 합니다. 
-embedding_model = DatabricksEmbeddings(endpoint=embedding_model_name)
+# 같은 질문을 반복하면 질문 임베딩을 캐시에서 가져오므로 임베딩 엔드포인트를 다시 호출하지 않습니다.
+# 리트리버와 함께 모델 서빙에 등록될 때는 캐시 설정만 직렬화되며, 서빙 컨테이너에서는 빈 캐시 파일을 새로 만들어 사용합니다.
+embedding_model = CachedEmbeddings(DatabricksEmbeddings(endpoint=embedding_model_name)
+                                   ,EmbeddingCache(embedding_model_name, path="/tmp/query_embedding_cache.sqlite", memory_items=1000, max_rows=100000)
+                                   )
 print(f"임베딩 테스트 : {embedding_model.embed_query('대한민국의 수도는?')[:5]}...\n")
 
+# True로 설정하면 벡터 검색 결과와 한국어 문자 n-gram BM25 검색 결과를 RRF로 결합합니다.
+# "소프트웨어진흥법 제2조 6"처럼 정확한 용어가 중요한 질문도 num_results를 늘리지 않고 찾을 수 있습니다.
+# BM25 인덱스는 노트북에서 미리 만들어 리트리버와 함께 모델 서빙에 등록되므로 서빙 컨테이너에서는 Spark 없이 동작합니다.
+hybrid_search = False
+lexical_index = BM25Index.from_table(f"{uc_catalog}.{uc_schema}.databricks_documentation") if hybrid_search else None
+
 def get_retriever(persist_dir: str = None):
     
     os.environ["DATABRICKS_HOST"] = host
@@ -814,16 +1021,21 @@ def get_retriever(persist_dir: str = None):
     vectorstore = DatabricksVectorSearch(
         index=vs_index, 
         embedding=embedding_model,
-        text_column="content" 
+        text_column="content",
+        columns=["header_1", "header_2", "header_3", "source", "page"]
     )
 
+    if hybrid_search:
+        return HybridRetriever(dense_retriever=vectorstore.as_retriever(search_kwargs={"k": 20}), lexical_index=lexical_index, k=4, fetch_k=20)
     return vectorstore.as_retriever()
 
 
 # Retriever를 통해 가장 유사한 문서 4개가 반환됨
 vectorstore = get_retriever()
 #similar_documents = vectorstore.get_relevant_documents("자동차 기업인 General Motors의 경우 Microsoft와 협력해 개발중인 생성형AI 서비스는?")
-similar_documents = vectorstore.invoke("자동차 기업인 General Motors의 경우 Microsoft와 협력해 개발중인 생성형AI 서비스는?")
+with span("retriever.invoke") as record:
+    similar_documents = call_with_retry(vector_search_endpoint_name, vectorstore.invoke, "자동차 기업인 General Motors의 경우 Microsoft와 협력해 개발중인 생성형AI 서비스는?")
+    record["items"] = len(similar_documents)
 print(f"\n============\n\nRelevant documents : {similar_documents[0]}")
 print(f"\n============\n\nRelevant documents : {similar_documents[1]}")
 print(f"\n============\n\nRelevant documents : {similar_documents[2]}")
@@ -853,7 +1065,7 @@ from langchain_community.chat_models import ChatDatabricks
 chat_model = ChatDatabricks(endpoint=generative_model_name, 
                             extra_params={"temperature": 0.1, "top_p": 0.95, "max_tokens": 1500}
                            )
-print(f"파운데이션 모델 테스트 : {chat_model.invoke('자동차 기업인 General Motors의 경우 Microsoft와 협력해 개발중인 생성형AI 서비스는?')}")
+print(f"파운데이션 모델 테스트 : {call_with_retry(generative_model_name, chat_model.invoke, '자동차 기업인 General Motors의 경우 Microsoft와 협력해 개발중인 생성형AI 서비스는?')}")
 
 # COMMAND ----------
 
@@ -892,7 +1104,8 @@ chain = RetrievalQA.from_chain_type(
 # 만약 보내진 전체 프롬프트를 확인하고 싶다면 아래 주석을 해제하여 langchain.debug = True를 사용
 # langchain.debug = True
 question = {"query": "석사에게 첫번째로 요구되는 SW기술 스택 수요는 무엇인가요?"}
-answer = chain.invoke(question)
+with span("chain.invoke"):
+    answer = call_with_retry(generative_model_name, chain.invoke, question)
 print(answer)
 
 # 엔드포인트에서 쿼리를 하고자 한다면 아래 구문 사용
@@ -913,6 +1126,13 @@ print(answer)
 
 # COMMAND ----------
 
+# DBTITLE 1,파이프라인 단계별 계측 결과를 델타 테이블에 저장
+# 위의 단계들에서 span으로 기록한 수행 시간, CPU 시간, 바이트 수, 항목 수를 확인하고 pipeline_metrics 테이블에 추가합니다.
+write_spans_to_table(f"{uc_catalog}.{uc_schema}.pipeline_metrics")
+display(pd.DataFrame(pipeline_spans))
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC # 6. 모델을 Unity Catalog에 저장 후 모델 서빙하기
 
@@ -1089,7 +1309,7 @@ def answer_chat(message, history, additional_input_info):
                     참고로 이전의 질문과 답변은 다음과 같습니다. 질문 : {history[len(history)-1][0]}. 답변 : {history[len(history)-1][1]}"""
         
     query_json = {"query": [query_string]}    
-    rag_response = rag_invoke(query_json)    
+    rag_response = call_with_retry(serving_endpoint_name, rag_invoke, query_json)
     answer = rag_response['predictions'][0]
 
     print(query_json)
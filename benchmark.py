@@ -0,0 +1,620 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # PDF 전처리 파이프라인 벤치마크
+# MAGIC
+# MAGIC 이 노트북에서는 Zero-to-GenAI-Workshop 노트북의 전처리 단계들의 수행 시간을 측정합니다.
+# MAGIC
+
+# COMMAND ----------
+
+# DBTITLE 1,벤치마크에 필요한 Python 패키지 설치
+!pip3 install -qqqq pymupdf==1.24.14 pymupdf4llm==0.0.10 langchain==0.1.20 aiohttp==3.10.0 mlflow==2.10.1
+dbutils.library.restartPython()
+
+# COMMAND ----------
+
+# DBTITLE 1,헬퍼 함수 초기화
+# MAGIC %run ./ingest-helpers
+
+# COMMAND ----------
+
+# DBTITLE 1,엔드포인트 호출 재시도 헬퍼 함수 초기화
+# MAGIC %run ./retry-helpers
+
+# COMMAND ----------
+
+# DBTITLE 1,임베딩 헬퍼 함수 초기화
+# MAGIC %run ./embedding-helpers
+
+# COMMAND ----------
+
+# DBTITLE 1,검색 헬퍼 함수 초기화
+# MAGIC %run ./retrieval-helpers
+
+# COMMAND ----------
+
+# DBTITLE 1,벤치마크 공통 변수 설정
+import time
+
+benchmark_pdf = "./krpdf.pdf"
+extract_kwargs = dict(write_images=False
+                      ,margins=(20, 60, 20, 60) # 왼쪽, 위쪽, 오른쪽, 아래
+                      ,table_strategy='lines_strict'
+                      ,page_chunks=False
+                      )
+
+with pymupdf.open(benchmark_pdf) as pdf:
+    benchmark_pages = list(range(pdf.page_count))
+
+print(f"{benchmark_pdf} : {len(benchmark_pages)} 페이지")
+
+# COMMAND ----------
+
+# DBTITLE 1,단일 호출 추출과 페이지 샤딩 병렬 추출의 수행 시간 비교
+start = time.perf_counter()
+single_md_text = pymupdf4llm.to_markdown(doc=benchmark_pdf, pages=benchmark_pages, **extract_kwargs)
+single_sec = time.perf_counter() - start
+print(f"단일 호출 : {single_sec:.2f}초")
+
+for workers in sorted({2, 4, os.cpu_count() or 1}):
+    start = time.perf_counter()
+    parallel_md_text = to_markdown_parallel(benchmark_pdf, pages=benchmark_pages, max_workers=workers, **extract_kwargs)
+    parallel_sec = time.perf_counter() - start
+    assert parallel_md_text == single_md_text, f"워커 {workers}개의 병렬 추출 결과가 단일 호출 결과와 다릅니다."
+    print(f"병렬 추출(워커 {workers}개) : {parallel_sec:.2f}초, {single_sec / parallel_sec:.2f}배")
+
+# COMMAND ----------
+
+# DBTITLE 1,페이지 캐시를 사용한 재실행 시간 비교
+import tempfile
+
+benchmark_cache = MarkdownPageCache(tempfile.mkdtemp())
+for run in ["최초 실행", "재실행"]:
+    start = time.perf_counter()
+    cached_md_text = to_markdown_cached(benchmark_pdf, benchmark_pages, benchmark_cache, **extract_kwargs)
+    print(f"{run} : {time.perf_counter() - start:.2f}초, {benchmark_cache.stats()}")
+assert cached_md_text == single_md_text, "캐시를 사용한 추출 결과가 단일 호출 결과와 다릅니다."
+
+# COMMAND ----------
+
+# DBTITLE 1,기존 re.sub 체인과 정규화 엔진의 처리량(MB/s) 비교
+def normalize_markdown_chain(md_text_temp):
+    # Zero-to-GenAI-Workshop 노트북의 정제 셀들을 순서대로 적용
+    md_text_temp = re.sub(re.compile(r'.*syntax error.*\n?'), '', md_text_temp)
+    md_text_temp = remove_page_footnotes(md_text_temp)
+    md_text_temp = re.sub(r'\x01', ' ', md_text_temp)
+    md_text_temp = re.sub(r'####', '#', md_text_temp)
+    md_text_temp = re.sub(r'^(\d+)\. ', r'## \1. ', md_text_temp, flags=re.MULTILINE)
+    md_text_temp = re.sub(r'^□', r'### ', md_text_temp, flags=re.MULTILINE)
+    md_text_temp = re.sub(r'ㅇ', '- ', md_text_temp)
+    md_text_temp = re.sub(r'→', ' 에서 ', md_text_temp)
+    md_text_temp = re.sub(r'’', '20', md_text_temp)
+    md_text_temp = re.sub(r'☞', '- ', md_text_temp)
+    md_text_temp = re.sub(r'[\*\*\[\]▲「」]', '', md_text_temp)
+    md_text_temp = re.sub(r'\([^()]*,[^()]*\)', '', md_text_temp)
+    md_text_temp = re.sub(r'-----', '', md_text_temp)
+    md_text_temp = md_text_temp.replace('\n\n', '')
+    md_text_temp = md_text_temp.replace('  ', ' ')
+    md_text_temp = re.sub(r'(#+)', r'\n\n\1', md_text_temp)
+    md_text_temp = re.sub(r'C\s*#', r'C#', md_text_temp)
+    md_text_temp = re.sub(r'- (?=\S)', r'\n\n- ', md_text_temp.strip())
+    md_text_temp = re.sub(r'(표 \d)', r'\n\n\1', md_text_temp)
+    md_text_temp = re.sub(r'(표 \d.*?)(\|)', r'\1\n\n\2', md_text_temp)
+    md_text_temp = re.sub(r'※[^­]*­', '\n', md_text_temp, flags=re.DOTALL)
+    return md_text_temp
+
+def measure_throughput(func, text, repeat=5):
+    size_mb = len(text.encode("utf-8")) / (1024 * 1024)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(text)
+    return result, size_mb * repeat / (time.perf_counter() - start)
+
+chain_md_text, chain_mb_per_sec = measure_throughput(normalize_markdown_chain, single_md_text)
+engine_md_text, engine_mb_per_sec = measure_throughput(normalize_markdown, single_md_text)
+assert engine_md_text == chain_md_text, "정규화 엔진의 결과가 기존 re.sub 체인의 결과와 다릅니다."
+print(f"re.sub 체인 : {chain_mb_per_sec:.2f} MB/s")
+print(f"정규화 엔진 : {engine_mb_per_sec:.2f} MB/s, {engine_mb_per_sec / chain_mb_per_sec:.2f}배")
+
+# COMMAND ----------
+
+# DBTITLE 1,긴 숫자열이 포함된 페이지에서 각주 제거의 선형 시간 확인
+# 각주 정규식 r'\d+\) .*(\n.*)*'는 긴 숫자열에서 시작 위치마다 다시 매칭하므로 입력 크기의 제곱에 비례하여 느려집니다.
+footnote_pattern = re.compile(r'\d+\) .*(\n.*)*')
+
+def adversarial_page(num_lines, line_length=2000):
+    return ("1" * line_length + "\n") * num_lines
+
+for sample in ["본문 1) 각주\n다음 줄", "2024년 12)각주 아님\n3) 각주\n4) 각주", "[1)] 본문 ١٢) 각주", adversarial_page(3, 50)]:
+    assert cut_footnotes(sample) == footnote_pattern.sub('', sample), sample
+
+cut_seconds = []
+for num_lines in [50, 100, 200, 400]:
+    page = adversarial_page(num_lines)
+    start = time.perf_counter()
+    cut_footnotes(page)
+    cut_seconds.append(time.perf_counter() - start)
+    print(f"{len(page):>8} 문자 : cut_footnotes {cut_seconds[-1] * 1000:.2f}ms")
+
+# 입력이 8배 늘어날 때 수행 시간도 선형 수준(여유를 두어 16배 이내)으로만 늘어나야 함
+assert cut_seconds[-1] <= max(cut_seconds[0], 1e-4) * 16, cut_seconds
+
+for num_lines in [50, 100]:
+    page = adversarial_page(num_lines)
+    start = time.perf_counter()
+    footnote_pattern.sub('', page)
+    print(f"{len(page):>8} 문자 : 기존 정규식 {(time.perf_counter() - start) * 1000:.2f}ms")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## 단계별 벤치마크
+# MAGIC
+# MAGIC - krpdf.pdf와 이를 10배, 100배로 늘린 합성 문서에 대해 추출, 정제 규칙별, 청킹, 청크 직렬화 단계를 측정합니다.
+# MAGIC - 합성 문서는 같은 페이지 목록을 반복하여 만들며, 외부 엔드포인트 없이 오프라인으로 실행됩니다.
+# MAGIC - 단계별 수행 시간, 처리량(MB/s), 최대 메모리(tracemalloc 기준 Python 힙)를 측정하고 결과를 JSONL 파일에 누적하여 이전 실행과 비교합니다.
+# MAGIC - 수행 시간은 tracemalloc 없이 측정하고, 최대 메모리는 같은 단계를 한 번 더 실행하여 측정합니다.
+
+# COMMAND ----------
+
+# DBTITLE 1,단계별 측정 함수 정의
+import json
+import tracemalloc
+import uuid
+from datetime import datetime, timezone
+from langchain_text_splitters import MarkdownHeaderTextSplitter
+
+benchmark_scales = [1, 10, 100]
+benchmark_results_path = "./benchmark_results.jsonl"
+benchmark_run_id = uuid.uuid4().hex[:8]
+benchmark_results = []
+
+def text_size_mb(value):
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) / (1024 * 1024)
+    return sum(len(chunk.page_content.encode("utf-8")) for chunk in value) / (1024 * 1024)
+
+def run_stage(stage, scale, func, value, measure_output=False):
+    # tracemalloc은 할당마다 추적 비용이 들어 Python 코드 위주 단계의 시간을 크게 늘리므로,
+    # 시간은 추적 없이 측정하고 최대 메모리는 같은 단계를 한 번 더 실행하여 따로 측정
+    start = time.perf_counter()
+    result = func(value)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    func(value)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # 추출 단계는 입력이 페이지 목록이므로 출력 텍스트 크기로 처리량을 계산
+    size_mb = text_size_mb(result if measure_output else value)
+    benchmark_results.append({"run_id": benchmark_run_id, "stage": stage, "scale": scale, "seconds": seconds,
+                              "mb_per_sec": size_mb / seconds if seconds else None, "input_mb": size_mb,
+                              "peak_mb": peak_bytes / (1024 * 1024)})
+    return result
+
+def rule_label(rule):
+    # 규칙 목록의 순서나 내용 표현이 바뀌어도 실행 간에 같은 규칙끼리 비교되도록 규칙 종류와 대상으로 짧은 이름을 만듦
+    kind = rule[0]
+    if kind == "regex":
+        target = rule[1].pattern
+    elif kind == "replace":
+        target = rule[1]
+    else:
+        target = rule[1].__name__
+    return f"rule:{kind}:{target[:24]!r}"
+
+# COMMAND ----------
+
+# DBTITLE 1,추출, 정제 규칙별, 청킹, 직렬화 단계 측정
+markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=HEADERS_TO_SPLIT_ON)
+
+for scale in benchmark_scales:
+    # 같은 페이지 목록을 반복하여 합성 문서를 만듦
+    md_text = run_stage("to_markdown", scale, lambda pages: pymupdf4llm.to_markdown(doc=benchmark_pdf, pages=pages, **extract_kwargs), benchmark_pages * scale, measure_output=True)
+
+    for rule in NORMALIZATION_RULES:
+        md_text = run_stage(rule_label(rule), scale, lambda text: apply_rules(text, [rule]), md_text)
+
+    md_header_splits = run_stage("split_text", scale, markdown_splitter.split_text, md_text)
+    run_stage("serialize", scale, lambda chunks: [chunk_row(chunk, benchmark_pdf) for chunk in chunks], md_header_splits)
+
+results_df = pd.DataFrame(benchmark_results)
+display(results_df)
+
+# COMMAND ----------
+
+# DBTITLE 1,측정 결과를 저장하고 이전 실행과 비교
+with open(benchmark_results_path, "a", encoding="utf-8") as f:
+    recorded_at = datetime.now(timezone.utc).isoformat()
+    for record in benchmark_results:
+        f.write(json.dumps({**record, "recorded_at": recorded_at}, ensure_ascii=False) + "\n")
+
+history_df = pd.read_json(benchmark_results_path, lines=True)
+previous_run_ids = [run_id for run_id in history_df["run_id"].unique() if run_id != benchmark_run_id]
+if previous_run_ids:
+    previous_df = history_df[history_df["run_id"] == previous_run_ids[-1]]
+    comparison_df = results_df.merge(previous_df, on=["stage", "scale"], suffixes=("", "_previous"))
+    comparison_df["seconds_ratio"] = comparison_df["seconds"] / comparison_df["seconds_previous"]
+    display(comparison_df[["stage", "scale", "seconds_previous", "seconds", "seconds_ratio", "peak_mb_previous", "peak_mb"]])
+else:
+    print(f"이전 실행 결과가 없습니다. {benchmark_results_path}에 이번 실행({benchmark_run_id}) 결과를 저장했습니다.")
+
+# COMMAND ----------
+
+# DBTITLE 1,표가 있는 페이지에만 표 감지를 수행하는 적응형 추출의 페이지당 절감 시간
+start = time.perf_counter()
+page_classes = classify_pages(benchmark_pdf, benchmark_pages)
+classify_sec = time.perf_counter() - start
+table_pages = [page for page in benchmark_pages if page_classes[page]["tables"]]
+text_pages = len(benchmark_pages) - len(table_pages)
+print(f"사전 분류 : {classify_sec * 1000:.1f}ms, 표 감지 대상 {len(table_pages)} / {len(benchmark_pages)} 페이지")
+
+# 같은 문서와 옵션으로 두 경로를 번갈아 실행하여 실행 순서에 따른 편차를 줄이고, 각 경로의 최솟값을 비교
+baseline_runs, adaptive_runs = [], []
+find_tables = pymupdf.Page.find_tables
+for _ in range(3):
+    start = time.perf_counter()
+    baseline_md_text = pymupdf4llm.to_markdown(doc=benchmark_pdf, pages=benchmark_pages, **extract_kwargs)
+    baseline_runs.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    adaptive_md_text = to_markdown_adaptive(benchmark_pdf, pages=benchmark_pages, **extract_kwargs)
+    adaptive_runs.append(time.perf_counter() - start)
+    assert adaptive_md_text == baseline_md_text, "적응형 추출 결과가 단일 호출 결과와 다릅니다."
+# 표 감지는 텍스트 전용 페이지 객체에서만 생략되고 pymupdf.Page 클래스는 바뀌지 않아야 함
+assert pymupdf.Page.find_tables is find_tables
+
+baseline_sec, adaptive_sec = min(baseline_runs), min(adaptive_runs)
+print(f"기존 추출 : {baseline_sec:.2f}초, 적응형 추출(사전 분류 포함) : {adaptive_sec:.2f}초")
+if text_pages:
+    print(f"텍스트 전용 페이지당 절감 시간 : {(baseline_sec - adaptive_sec) / text_pages * 1000:.1f}ms")
+
+# COMMAND ----------
+
+# DBTITLE 1,Spark mapInPandas 분산 추출과 드라이버 청킹의 결과 비교
+import importlib.util
+import shutil
+import tempfile
+
+if importlib.util.find_spec("pyspark") is None:
+    print("pyspark가 설치되어 있지 않아 Spark 분산 추출 비교를 건너뜁니다.")
+else:
+    from pyspark.sql import SparkSession
+
+    # Databricks에서는 실행 중인 세션을, 그 밖의 환경에서는 local[*] 세션을 사용
+    spark = SparkSession.getActiveSession() or SparkSession.builder.master("local[*]").appName("ingest-benchmark").getOrCreate()
+    if not spark.sparkContext.master.startswith("local"):
+        print(f"드라이버의 임시 파일을 Executor가 읽을 수 없으므로 로컬 모드가 아닌 클러스터({spark.sparkContext.master})에서는 건너뜁니다.")
+    else:
+        # 같은 PDF를 두 파일로 복사하여 두 파티션에 나누어 추출
+        spark_pdf_dir = tempfile.mkdtemp()
+        for name in ["a.pdf", "b.pdf"]:
+            shutil.copy(benchmark_pdf, os.path.join(spark_pdf_dir, name))
+        df_files = read_pdf_files(f"file:{spark_pdf_dir}", num_partitions=2)
+        assert df_files.rdd.getNumPartitions() == 2
+
+        start = time.perf_counter()
+        spark_chunks_df = extract_pdf_chunks(df_files, pages=benchmark_pages, **extract_kwargs)
+        spark_rows = spark_chunks_df.toPandas()
+        spark_sec = time.perf_counter() - start
+        # mapInPandas의 출력은 테이블에 저장하는 CHUNK_SCHEMA와 같은 스키마여야 함
+        assert spark_chunks_df.schema == spark.createDataFrame([], CHUNK_SCHEMA).schema
+
+        # 드라이버에서 같은 바이트와 출처로 청킹한 결과와 파일별 청크 수, 내용 해시, 페이지가 같아야 함
+        with open(benchmark_pdf, "rb") as f:
+            pdf_bytes = f.read()
+        start = time.perf_counter()
+        driver_rows = pd.DataFrame([chunk_row(chunk) for path in sorted(row["path"] for row in df_files.select("path").collect())
+                                    for chunk in stream_document_chunks(pdf_bytes, pages=benchmark_pages, source=path, **extract_kwargs)],
+                                   columns=CHUNK_COLUMNS)
+        driver_sec = time.perf_counter() - start
+        chunk_keys = lambda rows: sorted(zip(rows["source"], rows["chunk_hash"], rows["page"].astype("Int64").fillna(-1)))
+        assert spark_rows.groupby("source").size().to_dict() == driver_rows.groupby("source").size().to_dict()
+        assert chunk_keys(spark_rows) == chunk_keys(driver_rows)
+        print(f"{spark.sparkContext.master} 파티션 2개 : {spark_sec:.2f}초, 드라이버 순차 처리 : {driver_sec:.2f}초, 청크 {len(spark_rows)}개")
+        shutil.rmtree(spark_pdf_dir)
+
+# COMMAND ----------
+
+# DBTITLE 1,JSON 직렬화 content와 본문만 저장한 content의 청크당 토큰 수 비교
+benchmark_chunks = markdown_splitter.split_text(normalize_markdown(single_md_text))
+json_tokens = estimate_tokens([json.dumps(chunk.to_json()) for chunk in benchmark_chunks])
+text_tokens = estimate_tokens([chunk_row(chunk, benchmark_pdf)[0] for chunk in benchmark_chunks])
+
+print(f"청크 수 : {len(benchmark_chunks)}")
+print(f"JSON 직렬화 content : 청크당 평균 {json_tokens.mean():.1f} 토큰")
+print(f"본문 content : 청크당 평균 {text_tokens.mean():.1f} 토큰")
+print(f"청크당 평균 {(json_tokens - text_tokens).mean():.1f} 토큰, 전체 {1 - text_tokens.sum() / json_tokens.sum():.1%} 감소")
+
+# COMMAND ----------
+
+# DBTITLE 1,Document 리스트와 ChunkArray의 메모리 사용량 비교
+# 메모리의 대부분은 본문 문자열이 차지하므로 절감 폭은 크지 않습니다. krpdf 100배 규모에서 ChunkArray는 Document 리스트의 약 67%를 사용합니다.
+# 청크 수가 많을 때 메모리를 3분의 1 정도 줄이고, 청크마다 Python 객체를 만들지 않으며 Arrow로 바로 변환되는 정도의 이점으로 보면 됩니다.
+from langchain_core.documents import Document
+
+def synthetic_documents(chunks, scale):
+    # 청크마다 새로운 문자열을 만들어 두 방식 모두 본문 메모리를 포함하여 측정
+    for i in range(scale):
+        for chunk in chunks:
+            yield Document(page_content=f"{chunk.page_content} {i}", metadata={**chunk.metadata, "source": benchmark_pdf})
+
+def retained_mb(build):
+    tracemalloc.start()
+    result = build()
+    retained_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, retained_bytes / (1024 * 1024)
+
+for scale in benchmark_scales:
+    documents, documents_mb = retained_mb(lambda: list(synthetic_documents(benchmark_chunks, scale)))
+    del documents
+    chunk_array, chunk_array_mb = retained_mb(lambda: ChunkArray.from_documents(synthetic_documents(benchmark_chunks, scale)))
+    start = time.perf_counter()
+    chunk_array.to_arrow()
+    arrow_ms = (time.perf_counter() - start) * 1000
+    print(f"{len(chunk_array):>8} 청크 : Document 리스트 {documents_mb:.1f}MB, ChunkArray {chunk_array_mb:.1f}MB "
+          f"(Document 리스트 대비 {chunk_array_mb / documents_mb:.1%}, {1 - chunk_array_mb / documents_mb:.1%} 절감), Arrow 변환 {arrow_ms:.1f}ms")
+
+# COMMAND ----------
+
+# DBTITLE 1,로컬 엔드포인트에서 단건 순차 호출과 배치 동시 호출의 처리량 비교
+stand_in = StandInEndpoint(latency=0.05).start()
+embedding_texts = [chunk.page_content for chunk in benchmark_chunks]
+
+sequential_client = BatchEmbeddingClient("embedding_model", stand_in.host, max_batch_size=1, max_concurrency=1, requests_per_second=1000)
+batch_client = BatchEmbeddingClient("embedding_model", stand_in.host, max_batch_size=16, max_concurrency=8, requests_per_second=20)
+
+sequential_embeddings = sequential_client.embed(embedding_texts)
+batch_embeddings = batch_client.embed(embedding_texts)
+stand_in.stop()
+
+# 배치 크기와 동시성에 관계없이 입력 순서대로 같은 벡터가 반환되어야 함
+assert batch_embeddings == sequential_embeddings == [deterministic_embedding(text) for text in embedding_texts]
+for name, stats in [("단건 순차 호출", sequential_client.last_stats), ("배치 동시 호출", batch_client.last_stats)]:
+    print(f"{name} : {stats['requests']} 요청, {stats['seconds']:.2f}초, {stats['requests_per_sec']:.1f} req/s, {stats['texts_per_sec']:.1f} texts/s")
+
+# COMMAND ----------
+
+# DBTITLE 1,임베딩 캐시를 사용한 재실행의 엔드포인트 호출 수와 적중률
+import os
+
+stand_in = StandInEndpoint(latency=0.05).start()
+cache_path = "./.embedding_cache_benchmark.sqlite"
+if os.path.exists(cache_path):
+    os.remove(cache_path)
+embedding_cache = EmbeddingCache("embedding_model", path=cache_path)
+cached_client = BatchEmbeddingClient("embedding_model", stand_in.host, max_batch_size=16, max_concurrency=8, requests_per_second=20, cache=embedding_cache)
+
+for run in ["첫 실행", "재실행"]:
+    requests_before = stand_in.requests
+    start = time.perf_counter()
+    cached_embeddings = cached_client.embed(embedding_texts)
+    print(f"{run} : 엔드포인트 호출 {stand_in.requests - requests_before}회, {time.perf_counter() - start:.2f}초")
+stand_in.stop()
+
+assert np.allclose(cached_embeddings, batch_embeddings, atol=1e-6)
+# 모든 텍스트가 캐시에 있어 엔드포인트를 호출하지 않은 재실행도 캐시 없는 호출과 같은 통계 키를 가져야 함
+assert cached_client.last_stats.keys() == batch_client.last_stats.keys() and cached_client.last_stats["requests"] == 0
+print(cached_client.last_stats)
+print(embedding_cache.stats())
+
+# COMMAND ----------
+
+# DBTITLE 1,리트리버의 질문 임베딩 캐시와 메모리 계층 및 저장소의 삭제 수
+import pickle
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        return [deterministic_embedding(text) for text in texts]
+
+    def embed_query(self, text):
+        self.calls += 1
+        return deterministic_embedding(text)
+
+query_cache_path = "./.query_embedding_cache_benchmark.sqlite"
+if os.path.exists(query_cache_path):
+    os.remove(query_cache_path)
+counting_embeddings = CountingEmbeddings()
+query_embeddings = CachedEmbeddings(counting_embeddings, EmbeddingCache("embedding_model", path=query_cache_path, memory_items=8, max_rows=32))
+questions = list({query_embeddings.cache.key(text): text for text in embedding_texts}.values())[:64]
+
+# 같은 질문을 반복해도 임베딩 모델은 질문마다 한 번만 호출되어야 함
+for question in questions[:8] * 3:
+    query_embeddings.embed_query(question)
+assert counting_embeddings.calls == 8
+
+# 메모리 계층(8개)과 저장소(32행)의 한도를 넘긴 만큼 각각 삭제되고, 저장소의 행 수는 세지 않고 추적한 값과 같아야 함
+query_embeddings.embed_documents(questions)
+query_stats = query_embeddings.cache.stats()
+assert query_stats["memory_evictions"] == len(questions) - 8 and query_stats["store_evictions"] == len(questions) - 32
+assert query_embeddings.cache.row_count == query_embeddings.cache.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] == 32
+
+# 리트리버와 함께 직렬화하면 캐시 설정만 저장되고, 복원한 뒤에는 저장소에서 최근 질문의 임베딩을 읽어옴
+restored = pickle.loads(pickle.dumps(query_embeddings))
+assert np.allclose(restored.embed_query(questions[-1]), deterministic_embedding(questions[-1]), atol=1e-6)
+assert restored.embeddings.calls == counting_embeddings.calls
+print(query_stats, restored.cache.stats())
+
+# COMMAND ----------
+
+# DBTITLE 1,재시도 상태가 만들어진 뒤에도 임베딩 UDF가 Executor로 직렬화되는지 확인
+# 워크샵에서는 init-script의 엔드포인트 조회가 call_with_retry로 endpoint_throttles를 먼저 채우므로 같은 순서로 확인
+from pyspark import cloudpickle
+
+stand_in = StandInEndpoint().start()
+call_with_retry("embedding_model", lambda: None)
+assert endpoint_throttles, "재시도 상태가 만들어지지 않았습니다."
+shipped_udf = cloudpickle.loads(cloudpickle.dumps(embedding_udf("embedding_model", stand_in.host).func))
+shipped_embeddings = next(shipped_udf(iter([pd.Series(embedding_texts[:4])])))
+stand_in.stop()
+assert np.allclose(np.stack(shipped_embeddings), np.array(batch_embeddings[:4]), atol=1e-6)
+print("직렬화한 임베딩 UDF가 재시도 상태와 함께 복원되어 동일한 벡터를 반환합니다.")
+
+# COMMAND ----------
+
+# DBTITLE 1,float32, float16, int8 벡터 저장 형식의 저장 크기, 검색 시간, recall@k 비교
+benchmark_k = 10
+corpus_texts = [f"{text} {i}" for i in range(max(benchmark_scales)) for text in embedding_texts]
+corpus_vectors = np.array([deterministic_embedding(text) for text in corpus_texts], dtype=np.float32)
+
+# 청크 벡터에 잡음을 더한 질의로 float32 전체 탐색 결과를 정답으로 사용
+rng = np.random.default_rng(0)
+query_vectors = corpus_vectors[rng.choice(len(corpus_vectors), 100, replace=False)]
+query_vectors = query_vectors + rng.normal(0, 0.01, query_vectors.shape).astype(np.float32)
+query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+exact_top_k = np.argsort(-(query_vectors @ corpus_vectors.T), axis=1)[:, :benchmark_k]
+
+print(f"{len(corpus_vectors)} 벡터, {len(query_vectors)} 질의, recall@{benchmark_k}")
+for dtype in EMBEDDING_DTYPES:
+    codes, scales = quantize_embeddings(corpus_vectors, dtype)
+    storage_bytes = codes.nbytes + (scales.nbytes if dtype == "int8" else 0)
+    start = time.perf_counter()
+    top_k = np.argsort(-score_embeddings(codes, scales, query_vectors), axis=1)[:, :benchmark_k]
+    search_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+    recall = np.mean([len(set(a) & set(b)) / benchmark_k for a, b in zip(top_k, exact_top_k)])
+    print(f"{dtype:>8} : {storage_bytes / (1024 * 1024):.1f}MB ({storage_bytes / corpus_vectors.nbytes:.0%}), 질의당 {search_ms:.2f}ms, recall@{benchmark_k} {recall:.3f}")
+
+# COMMAND ----------
+
+# DBTITLE 1,로컬 엔드포인트로 청킹부터 임베딩, 검색, 답변 생성까지 전체 경로 측정
+import mlflow.deployments
+
+# 응답 시간은 로그 정규 분포를 따르고, 요청의 5%와 초당 토큰 한도를 넘는 요청에는 429를 반환
+pipeline_stand_in = StandInEndpoint(latency=lognormal_latency(0.05, sigma=0.5), throttle_rate=0.05, retry_after=0.2, tokens_per_second=200000).start()
+benchmark_questions = ["SW융합산업에서 자동차 산업의 경우 구직자의 근무지는 주로 어디인가요?",
+                       "자동차 기업인 General Motors의 경우 Microsoft와 협력해 개발중인 생성형AI 서비스는?"]
+pipeline_timings = {}
+
+start = time.perf_counter()
+pipeline_chunks = split_by_token_budget(markdown_splitter.split_text(normalize_markdown(single_md_text)), max_tokens=1000, overlap_tokens=100)
+pipeline_timings["chunking"] = time.perf_counter() - start
+
+start = time.perf_counter()
+pipeline_client = BatchEmbeddingClient("embedding_model", pipeline_stand_in.host, max_batch_size=16, max_concurrency=8, requests_per_second=50)
+chunk_codes, chunk_scales = quantize_embeddings(pipeline_client.embed([chunk.page_content for chunk in pipeline_chunks]), "float16")
+pipeline_timings["embedding"] = time.perf_counter() - start
+
+start = time.perf_counter()
+question_vectors = np.array(pipeline_client.embed(benchmark_questions), dtype=np.float32)
+retrieved = np.argsort(-score_embeddings(chunk_codes, chunk_scales, question_vectors), axis=1)[:, :4]
+pipeline_timings["retrieval"] = time.perf_counter() - start
+
+start = time.perf_counter()
+with stand_in_environment(pipeline_stand_in):
+    deploy_client = mlflow.deployments.get_deploy_client("databricks")
+    answers = []
+    conversations = []
+    for question, indexes in zip(benchmark_questions, retrieved):
+        context = "\n\n".join(pipeline_chunks[i].page_content for i in indexes)
+        conversations.append([{"role": "user", "content": f"{context}\nQuestion: {question}\nAnswer:"}])
+        response = call_with_retry("foundation_model", deploy_client.predict, endpoint="foundation_model",
+                                   inputs={"messages": conversations[-1], "max_tokens": 256})
+        answers.append(response["choices"][0]["message"]["content"])
+pipeline_timings["generation"] = time.perf_counter() - start
+pipeline_stand_in.stop()
+
+# 같은 대화에는 항상 같은 답변이 반환되어야 함
+assert answers == [deterministic_answer(messages, 256) for messages in conversations]
+for stage, seconds in pipeline_timings.items():
+    print(f"{stage:>10} : {seconds:.2f}초")
+print(f"엔드포인트 : {pipeline_stand_in.stats}, 클라이언트 재시도 : {pipeline_client.last_stats['retries']}회")
+
+# COMMAND ----------
+
+# DBTITLE 1,로컬 IVF 인덱스의 탐색 리스트 수(nprobe)별 검색 시간과 recall@k
+import shutil
+
+local_index_dir = "./.local_vector_index_benchmark"
+shutil.rmtree(local_index_dir, ignore_errors=True)
+start = time.perf_counter()
+local_index = LocalVectorIndex.build(local_index_dir, corpus_vectors, pd.DataFrame({"id": np.arange(len(corpus_texts)), "content": corpus_texts}), dtype="float16")
+print(f"{len(corpus_vectors)} 벡터, {local_index.meta['n_lists']} 리스트 인덱스 생성 : {time.perf_counter() - start:.2f}초")
+
+codes, scales = quantize_embeddings(corpus_vectors, "float16")
+start = time.perf_counter()
+for query_vector in query_vectors:
+    np.argsort(-score_embeddings(codes, scales, query_vector)[0])[:benchmark_k]
+print(f"전체 탐색 : 질의당 {(time.perf_counter() - start) * 1000 / len(query_vectors):.2f}ms")
+
+row_ids = local_index.rows["id"].to_numpy()
+recalls = {}
+for nprobe in [None, 1, 4, 16, local_index.meta["n_lists"]]:
+    start = time.perf_counter()
+    local_results = [local_index.search_vectors(query_vector, benchmark_k, nprobe)[0] for query_vector in query_vectors]
+    search_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+    recalls[nprobe] = np.mean([len(set(row_ids[positions]) & set(exact)) / benchmark_k for (positions, _), exact in zip(local_results, exact_top_k)])
+    print(f"nprobe {nprobe or '기본':>4} : 질의당 {search_ms:.2f}ms, recall@{benchmark_k} {recalls[nprobe]:.3f}")
+# nprobe를 지정하지 않으면 정확히 탐색하므로 recall이 떨어지지 않아야 함
+assert recalls[None] >= 0.99
+
+# 목표 recall에 맞춰 정한 nprobe는 index.json에 저장되어 이후 기본 탐색에 사용됨
+target_recall = 0.9
+tuned_nprobe, tuned_recall = local_index.tune_nprobe(query_vectors, benchmark_k, target_recall)
+assert tuned_recall >= target_recall and LocalVectorIndex(local_index_dir).meta["nprobe"] == tuned_nprobe
+print(f"recall@{benchmark_k} {target_recall} 목표 nprobe : {tuned_nprobe} (recall {tuned_recall:.3f})")
+
+# filters를 지정하면 조건을 만족하는 행만 검색
+filtered = local_index.similarity_search(["id"], query_vector=query_vectors[0], filters={"id <": 1000}, num_results=benchmark_k)
+assert filtered["result"]["row_count"] == benchmark_k and all(row[0] < 1000 for row in filtered["result"]["data_array"])
+
+# COMMAND ----------
+
+# DBTITLE 1,질문별 반복 검색과 블록 행렬 곱 일괄 상위 k개 검색의 수행 시간 비교
+batch_queries = corpus_vectors[rng.choice(len(corpus_vectors), 1000, replace=False)]
+batch_queries = batch_queries + rng.normal(0, 0.01, batch_queries.shape).astype(np.float32)
+
+start = time.perf_counter()
+loop_top_k = np.array([np.argsort(-(corpus_vectors @ query_vector))[:benchmark_k] for query_vector in batch_queries])
+loop_sec = time.perf_counter() - start
+
+start = time.perf_counter()
+batch_positions, batch_scores = batch_top_k(corpus_vectors, np.ones(len(corpus_vectors), dtype=np.float32), batch_queries, benchmark_k, block_rows=4096)
+batch_sec = time.perf_counter() - start
+
+# 블록으로 나누어도 전체 탐색과 같은 상위 k개가 같은 순서로 반환되어야 함
+assert (batch_positions == loop_top_k).all()
+print(f"{len(batch_queries)} 질문 x {len(corpus_vectors)} 청크, 상위 {benchmark_k}개")
+print(f"질문별 반복 : {loop_sec:.2f}초, 일괄 검색 : {batch_sec:.2f}초 ({loop_sec / batch_sec:.0f}배)")
+print(f"로컬 인덱스 일괄 검색 : {len(local_index.batch_search(batch_queries, benchmark_k)[0])} 질문")
+shutil.rmtree(local_index_dir)
+
+# COMMAND ----------
+
+# DBTITLE 1,BM25, 벡터, 하이브리드(RRF) 검색의 정확한 용어 질의 recall@k와 질의 시간 비교
+# 청크 본문의 일부 구간을 그대로 질의로 사용하여 해당 청크가 상위 k개에 포함되는지 확인
+# 로컬 엔드포인트의 벡터는 텍스트의 의미를 반영하지 않으므로 벡터 검색 recall은 하한값으로만 참고
+hybrid_k = 4
+chunk_rows = pd.DataFrame({"id": np.arange(len(benchmark_chunks)), "content": [chunk.page_content for chunk in benchmark_chunks]})
+
+start = time.perf_counter()
+lexical_index = BM25Index.build(chunk_rows)
+print(f"BM25 인덱스 생성 : {len(chunk_rows)} 청크, {len(lexical_index.vocabulary)} 용어, {(time.perf_counter() - start) * 1000:.1f}ms")
+
+shutil.rmtree(local_index_dir, ignore_errors=True)
+chunk_index = LocalVectorIndex.build(local_index_dir, [deterministic_embedding(text) for text in chunk_rows["content"]], chunk_rows,
+                                     n_lists=1, embed_query=deterministic_embedding)
+retrievers = {"vector": LocalVectorSearchRetriever(index=chunk_index, columns=["id"], k=hybrid_k),
+              "bm25": None,
+              "hybrid": HybridRetriever(dense_retriever=LocalVectorSearchRetriever(index=chunk_index, columns=["id"], k=20),
+                                        lexical_index=lexical_index, k=hybrid_k, fetch_k=20)}
+
+term_queries = []
+for chunk_id, text in zip(chunk_rows["id"], chunk_rows["content"]):
+    words = text.split()
+    if len(words) >= 3:
+        offset = rng.integers(0, len(words) - 2)
+        term_queries.append((chunk_id, " ".join(words[offset:offset + 3])))
+
+for name, retriever in retrievers.items():
+    hits = 0
+    start = time.perf_counter()
+    for chunk_id, query in term_queries:
+        documents = lexical_index.search_documents(query, hybrid_k) if retriever is None else retriever.invoke(query)
+        hits += chunk_id in [_fusion_key(document, "id") for document in documents]
+    query_ms = (time.perf_counter() - start) * 1000 / len(term_queries)
+    print(f"{name:>7} : 질의당 {query_ms:.2f}ms, recall@{hybrid_k} {hits / len(term_queries):.3f}")
+shutil.rmtree(local_index_dir)
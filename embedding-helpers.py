@@ -0,0 +1,512 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # 임베딩 모델 호출을 위한 헬퍼 노트북입니다.
+# MAGIC
+# MAGIC 이 노트북에서는 요청 제한, 임베딩 엔드포인트를 배치로 호출하는 클라이언트와 오프라인 테스트를 위한 로컬 임베딩 및 채팅 엔드포인트가 포함되어 있습니다.
+# MAGIC 엔드포인트 호출의 재시도와 서킷 브레이커는 retry-helpers 노트북의 함수를 사용합니다.
+# MAGIC
+
+# COMMAND ----------
+
+import asyncio
+import hashlib
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import numpy as np
+
+# COMMAND ----------
+
+# DBTITLE 1,요청 속도를 제한하는 토큰 버킷
+class TokenBucket:
+    # 초당 rate개의 토큰이 채워지고 최대 capacity개까지 쌓이며, 요청마다 토큰을 하나씩 사용
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1.0):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+# COMMAND ----------
+
+# DBTITLE 1,여러 텍스트를 배치로 묶어 동시에 호출하는 임베딩 클라이언트
+def run_async(coroutine):
+    # 노트북에서는 이미 이벤트 루프가 실행 중일 수 있으므로 별도 스레드에서 실행
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+class BatchEmbeddingClient:
+    def __init__(self, endpoint, host, token=None, max_batch_size=16, max_concurrency=8, requests_per_second=5.0, max_retries=5, cache=None,
+                 timeout=60.0):
+        self.url = f"{host}/serving-endpoints/{endpoint}/invocations"
+        self.headers = {"Content-Type": "application/json"}
+        if token:
+            self.headers["Authorization"] = f"Bearer {token}"
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.cache = cache
+        # 응답이 없는 요청 하나가 배치 전체를 멈추지 않도록 요청마다 제한 시간을 두고, 시간 초과는 재시도 대상으로 처리
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.last_stats = self._new_stats()
+
+    def _new_stats(self, texts=0, batches=0):
+        # 캐시 사용 여부나 엔드포인트 호출 여부와 관계없이 항상 같은 키를 가지며, texts는 엔드포인트로 보낸 텍스트 수
+        return {"requests": 0, "retries": 0, "texts": texts, "batches": batches, "seconds": 0.0,
+                "requests_per_sec": None, "texts_per_sec": None, "cached": 0, "duplicates": 0}
+
+    def _finish_stats(self, start):
+        seconds = time.perf_counter() - start
+        self.last_stats.update({"seconds": seconds,
+                                "requests_per_sec": self.last_stats["requests"] / seconds if seconds else None,
+                                "texts_per_sec": self.last_stats["texts"] / seconds if seconds else None})
+
+    async def _embed_batch(self, session, batch, semaphore, bucket):
+        throttle = throttle_for(self.url)
+        throttle.before_call()
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                await bucket.acquire()
+                try:
+                    async with session.post(self.url, json={"input": batch}, headers=self.headers) as response:
+                        status = response.status
+                        retry_after = retry_after_seconds(response.headers)
+                        if status == 200:
+                            payload = await response.json()
+                        elif status not in RETRYABLE_STATUS:
+                            throttle.release()
+                            raise Exception(f"Request failed with status {status}, {await response.text()}")
+                    error = None
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    # 연결 끊김과 시간 초과는 상태 코드 없이 실패한 일시적 오류로 보고 재시도
+                    status, retry_after, error = None, None, e
+            self.last_stats["requests"] += 1
+            if status == 200:
+                throttle.record_success()
+                break
+            if attempt == self.max_retries:
+                throttle.record_failure()
+                reason = repr(error) if error else f"status {status}"
+                raise Exception(f"Request failed with {reason} after {attempt + 1} attempts") from error
+            # 대기하는 동안에는 동시 호출 슬롯을 반납하여 다른 배치가 진행되도록 함
+            self.last_stats["retries"] += 1
+            await asyncio.sleep(throttle.delay(attempt, retry_after))
+        # 응답의 index 기준으로 정렬하여 입력 순서와 같은 벡터를 반환
+        return [item["embedding"] for item in sorted(payload["data"], key=lambda item: item.get("index", 0))]
+
+    async def aembed(self, texts):
+        batches = [texts[i:i + self.max_batch_size] for i in range(0, len(texts), self.max_batch_size)]
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        bucket = TokenBucket(self.requests_per_second)
+        self.last_stats = self._new_stats(len(texts), len(batches))
+        start = time.perf_counter()
+        async with aiohttp.ClientSession(timeout=self.timeout) as session:
+            results = await asyncio.gather(*[self._embed_batch(session, batch, semaphore, bucket) for batch in batches])
+        self._finish_stats(start)
+        return [vector for batch_vectors in results for vector in batch_vectors]
+
+    def embed(self, texts):
+        texts = list(texts)
+        if self.cache is None:
+            return run_async(self.aembed(texts))
+        # 캐시를 사용하면 모든 텍스트가 캐시에 있어 엔드포인트를 호출하지 않은 경우도 포함하여 캐시 조회 시간까지 측정
+        start = time.perf_counter()
+        self.last_stats = self._new_stats()
+        vectors, requested, duplicates = self.cache.embed_through(texts, lambda missing: run_async(self.aembed(missing)))
+        self._finish_stats(start)
+        # 캐시에 없지만 같은 호출 안에서 앞의 텍스트와 키가 같아 함께 계산된 텍스트는 캐시 적중과 구분하여 집계
+        self.last_stats["cached"] = len(texts) - requested - duplicates
+        self.last_stats["duplicates"] = duplicates
+        return vectors
+
+# COMMAND ----------
+
+# DBTITLE 1,오프라인 테스트를 위한 로컬 임베딩 및 채팅 엔드포인트
+import json
+import os
+from contextlib import contextmanager
+from aiohttp import web
+
+def deterministic_embedding(text, dimension=1536):
+    # 같은 텍스트는 항상 같은 단위 벡터를 반환
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimension)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+def deterministic_answer(messages, max_tokens=256):
+    # 같은 대화에는 항상 같은 답변을 반환하며, 답변은 마지막 메시지의 앞부분을 max_tokens 단어까지 사용
+    digest = hashlib.sha256(json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    words = messages[-1]["content"].split()[:max_tokens]
+    return f"[stand-in {digest}] " + " ".join(words)
+
+def approximate_tokens(text):
+    return len(text.encode("utf-8")) // 4 + 1
+
+def lognormal_latency(median, sigma=0.5):
+    # 응답 시간의 긴 꼬리를 흉내내는 로그 정규 분포
+    return lambda rng: median * rng.lognormvariate(0, sigma)
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class StandInEndpoint:
+    # Databricks 서빙 엔드포인트의 /serving-endpoints/{name}/invocations 요청 형식(llm/v1/embeddings, llm/v1/chat)을 로컬에서 흉내냄
+    # latency는 초 단위 값 또는 random.Random을 받아 초를 반환하는 함수이며, throttle_rate 비율의 요청에 429를 반환하고,
+    # tokens_per_second를 지정하면 초당 입력과 출력 토큰 수가 이를 넘는 요청에 Retry-After와 함께 429를 반환
+    def __init__(self, dimension=1536, latency=0.0, throttle_rate=0.0, retry_after=1.0, tokens_per_second=None, seed=0, port=None):
+        self.dimension = dimension
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.tokens_per_second = tokens_per_second
+        self.rng = random.Random(seed)
+        self.available_tokens = tokens_per_second or 0
+        self.updated = time.monotonic()
+        self.port = port or _free_port()
+        self.host = f"http://127.0.0.1:{self.port}"
+        self.requests = 0
+        self.stats = {"requests": 0, "throttled": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    def _take_tokens(self, tokens):
+        # 토큰이 부족하면 다시 요청할 때까지 기다려야 하는 시간을 반환
+        if not self.tokens_per_second:
+            return None
+        now = time.monotonic()
+        self.available_tokens = min(self.tokens_per_second, self.available_tokens + (now - self.updated) * self.tokens_per_second)
+        self.updated = now
+        if self.available_tokens >= min(tokens, self.tokens_per_second):
+            self.available_tokens -= tokens
+            return None
+        return (min(tokens, self.tokens_per_second) - self.available_tokens) / self.tokens_per_second
+
+    def _throttled(self, retry_after):
+        self.stats["throttled"] += 1
+        return web.json_response({"error_code": "REQUEST_LIMIT_EXCEEDED", "message": "Stand-in endpoint rate limit exceeded."},
+                                 status=429, headers={"Retry-After": f"{retry_after:.3f}"})
+
+    def _embeddings(self, name, body):
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        prompt_tokens = sum(approximate_tokens(text) for text in inputs)
+        return prompt_tokens, 0, {"object": "list",
+                                  "model": name,
+                                  "data": [{"object": "embedding", "index": i, "embedding": deterministic_embedding(text, self.dimension)}
+                                           for i, text in enumerate(inputs)],
+                                  "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}}
+
+    def _chat(self, name, body):
+        answer = deterministic_answer(body["messages"], body.get("max_tokens") or 256)
+        prompt_tokens = sum(approximate_tokens(message["content"]) for message in body["messages"])
+        completion_tokens = approximate_tokens(answer)
+        return prompt_tokens, completion_tokens, {"id": f"chatcmpl-{hashlib.sha256(answer.encode('utf-8')).hexdigest()[:16]}",
+                                                  "object": "chat.completion",
+                                                  "created": int(time.time()),
+                                                  "model": name,
+                                                  "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                                                  "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                                            "total_tokens": prompt_tokens + completion_tokens}}
+
+    async def _invocations(self, request):
+        body = await request.json()
+        self.requests += 1
+        self.stats["requests"] += 1
+        if self.rng.random() < self.throttle_rate:
+            return self._throttled(self.retry_after)
+        if "input" in body:
+            prompt_tokens, completion_tokens, payload = self._embeddings(request.match_info["name"], body)
+        elif "messages" in body:
+            prompt_tokens, completion_tokens, payload = self._chat(request.match_info["name"], body)
+        else:
+            return web.json_response({"error_code": "BAD_REQUEST", "message": "Expected 'input' or 'messages'."}, status=400)
+        wait = self._take_tokens(prompt_tokens + completion_tokens)
+        if wait is not None:
+            return self._throttled(wait)
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["completion_tokens"] += completion_tokens
+        await asyncio.sleep(self.latency(self.rng) if callable(self.latency) else self.latency)
+        return web.json_response(payload)
+
+    def start(self):
+        ready = threading.Event()
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            app = web.Application()
+            app.router.add_post("/serving-endpoints/{name}/invocations", self._invocations)
+            self.runner = web.AppRunner(app)
+            self.loop.run_until_complete(self.runner.setup())
+            self.loop.run_until_complete(web.TCPSite(self.runner, "127.0.0.1", self.port).start())
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+@contextmanager
+def stand_in_environment(endpoint):
+    # mlflow.deployments의 databricks 클라이언트와 ChatDatabricks, DatabricksEmbeddings가 로컬 엔드포인트를 호출하도록 환경 변수를 임시로 변경
+    previous = {key: os.environ.get(key) for key in ("DATABRICKS_HOST", "DATABRICKS_TOKEN")}
+    os.environ.update(DATABRICKS_HOST=endpoint.host, DATABRICKS_TOKEN="stand-in")
+    try:
+        yield endpoint
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+# COMMAND ----------
+
+# DBTITLE 1,float16, int8 양자화 벡터 저장 형식
+EMBEDDING_DTYPES = ("float32", "float16", "int8")
+
+def quantize_embeddings(vectors, dtype="int8"):
+    # int8은 벡터마다 절댓값 최대치를 127로 맞추는 scale을 함께 저장하며, float32와 float16의 scale은 1
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"dtype must be one of {EMBEDDING_DTYPES}: {dtype}")
+    scales = np.ones(len(vectors), dtype=np.float32)
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    return vectors.astype(dtype), scales
+
+def dequantize_embeddings(codes, scales):
+    codes = np.asarray(codes)
+    if codes.dtype != np.int8:
+        # float32와 float16은 scale이 1이므로 형 변환만 수행
+        return codes.astype(np.float32, copy=False)
+    return codes.astype(np.float32) * np.asarray(scales, dtype=np.float32)[:, None]
+
+def score_embeddings(codes, scales, queries, block_rows=65536):
+    # 양자화된 벡터 전체를 float32로 복원하지 않도록 block_rows개씩 복원하여 내적을 계산
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+    for start in range(0, len(codes), block_rows):
+        block = dequantize_embeddings(codes[start:start + block_rows], scales[start:start + block_rows])
+        scores[:, start:start + len(block)] = queries @ block.T
+    return scores
+
+# COMMAND ----------
+
+# DBTITLE 1,모델과 텍스트 해시를 키로 사용하는 영구 임베딩 캐시
+import sqlite3
+import unicodedata
+from collections import OrderedDict
+from langchain_core.embeddings import Embeddings
+
+def normalize_embedding_text(text):
+    # 유니코드 정규화와 공백 정리만 다른 텍스트는 같은 키를 사용
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+class EmbeddingCache:
+    # 메모리 LRU 계층과 SQLite 영구 저장소로 구성되며, 저장소는 max_rows를 넘으면 가장 오래 사용하지 않은 벡터부터 삭제
+    # 저장소의 벡터는 dtype(float32, float16, int8) 형식으로 양자화하여 scale과 함께 저장
+    def __init__(self, model, path="./.embedding_cache.sqlite", memory_items=10000, max_rows=1000000, dtype="float32"):
+        self.model = model
+        self.dtype = dtype
+        self.path = path
+        self.memory_items = memory_items
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.connection = None
+        self.row_count = None
+        self.memory_hits = self.store_hits = self.misses = self.memory_evictions = self.store_evictions = 0
+
+    def __getstate__(self):
+        # 모델 서빙에 리트리버를 등록할 때 연결과 메모리 계층은 직렬화하지 않음
+        state = self.__dict__.copy()
+        state.update(lock=None, memory=OrderedDict(), connection=None, row_count=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, text_hash TEXT, vector BLOB, dtype TEXT, scale REAL, last_used REAL, PRIMARY KEY (model, text_hash))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            # 저장 때마다 전체 행을 세지 않도록 연결 시 한 번만 세고 이후에는 추가 및 삭제한 행 수로 갱신
+            self.row_count = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return self.connection
+
+    def key(self, text):
+        return hashlib.sha256(normalize_embedding_text(text).encode("utf-8")).hexdigest()
+
+    def _remember(self, text_hash, vector):
+        self.memory[text_hash] = vector
+        self.memory.move_to_end(text_hash)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+            self.memory_evictions += 1
+
+    def get_many(self, texts):
+        # 캐시에 없는 텍스트는 None을 반환
+        hashes = [self.key(text) for text in texts]
+        vectors = [None] * len(texts)
+        with self.lock:
+            pending = {}
+            for i, text_hash in enumerate(hashes):
+                if text_hash in self.memory:
+                    self.memory.move_to_end(text_hash)
+                    vectors[i] = self.memory[text_hash]
+                    self.memory_hits += 1
+                else:
+                    pending.setdefault(text_hash, []).append(i)
+            if pending:
+                connection = self._connect()
+                pending_hashes = list(pending)
+                for start in range(0, len(pending_hashes), 500):
+                    batch = pending_hashes[start:start + 500]
+                    rows = connection.execute(f"SELECT text_hash, vector, dtype, scale FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                                              [self.model, *batch]).fetchall()
+                    for text_hash, blob, dtype, scale in rows:
+                        vector = (np.frombuffer(blob, dtype=dtype).astype(np.float32) * np.float32(scale)).tolist()
+                        self._remember(text_hash, vector)
+                        for i in pending.pop(text_hash):
+                            vectors[i] = vector
+                            self.store_hits += 1
+                    connection.execute(f"UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                                       [time.time(), self.model, *batch])
+                connection.commit()
+                self.misses += sum(len(indexes) for indexes in pending.values())
+        return vectors
+
+    def put_many(self, texts, vectors):
+        if not texts:
+            return
+        codes, scales = quantize_embeddings(vectors, self.dtype)
+        rows = [(self.model, self.key(text), code.tobytes(), self.dtype, float(scale), time.time()) for text, code, scale in zip(texts, codes, scales)]
+        with self.lock:
+            # 메모리 계층에도 저장소에서 읽을 때와 같은 복원 값을 저장
+            for (_, text_hash, *_), vector in zip(rows, dequantize_embeddings(codes, scales)):
+                self._remember(text_hash, vector.tolist())
+            connection = self._connect()
+            # 새 키만 추가하여 행 수를 갱신하고, 이미 있는 키는 벡터와 사용 시각만 덮어씀
+            inserted = connection.executemany("INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?, ?, ?, ?)", rows).rowcount
+            if inserted < len(rows):
+                connection.executemany("UPDATE embeddings SET vector = ?, dtype = ?, scale = ?, last_used = ? WHERE model = ? AND text_hash = ?",
+                                       [(vector, dtype, scale, last_used, model, text_hash) for model, text_hash, vector, dtype, scale, last_used in rows])
+            self.row_count += inserted
+            self._evict(connection)
+            connection.commit()
+
+    def embed_through(self, texts, embed):
+        # 캐시에 없는 텍스트만 키 기준으로 중복 없이 embed로 계산하여 저장하고, 요청한 텍스트 수와 그 요청에 합쳐진 중복 텍스트 수를 함께 반환
+        vectors = self.get_many(texts)
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(self.key(texts[i]), []).append(i)
+        if missing:
+            representatives = [texts[indexes[0]] for indexes in missing.values()]
+            computed = embed(representatives)
+            self.put_many(representatives, computed)
+            for indexes, vector in zip(missing.values(), computed):
+                for i in indexes:
+                    vectors[i] = vector
+        return vectors, len(missing), sum(len(indexes) - 1 for indexes in missing.values())
+
+    def _evict(self, connection):
+        if self.row_count > self.max_rows:
+            deleted = connection.execute("DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                                         (self.row_count - self.max_rows,)).rowcount
+            self.row_count -= deleted
+            self.store_evictions += deleted
+
+    def stats(self):
+        lookups = self.memory_hits + self.store_hits + self.misses
+        return {"memory_hits": self.memory_hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.store_hits) / lookups if lookups else None,
+                "memory_evictions": self.memory_evictions,
+                "store_evictions": self.store_evictions}
+
+class CachedEmbeddings(Embeddings):
+    # DatabricksEmbeddings 등 랭체인 임베딩 모델을 감싸 캐시에 없는 텍스트만 엔드포인트로 요청
+    def __init__(self, embeddings, cache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def embed_documents(self, texts):
+        return self.cache.embed_through(texts, self.embeddings.embed_documents)[0]
+
+    def embed_query(self, text):
+        vector = self.cache.get_many([text])[0]
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put_many([text], [vector])
+        return vector
+
+# COMMAND ----------
+
+# DBTITLE 1,Spark Executor에서 배치로 임베딩을 계산하는 자체 관리 임베딩
+from typing import Iterator
+import pandas as pd
+import pyspark.sql.functions as F
+from pyspark.sql.functions import pandas_udf
+
+EMBEDDING_COLUMN = "embedding"
+
+def embedding_udf(endpoint, host, token=None, max_batch_size=16, max_concurrency=4, requests_per_second=1.0, cache_path=None):
+    # Task마다 클라이언트를 한 번만 만들고, requests_per_second와 max_concurrency는 Task 하나에 적용되는 값
+    @pandas_udf("array<float>")
+    def embed(batches: Iterator[pd.Series]) -> Iterator[pd.Series]:
+        cache = EmbeddingCache(endpoint, path=cache_path) if cache_path else None
+        client = BatchEmbeddingClient(endpoint, host, token=token, max_batch_size=max_batch_size, max_concurrency=max_concurrency,
+                                      requests_per_second=requests_per_second, cache=cache)
+        for texts in batches:
+            yield pd.Series(client.embed(texts.tolist()))
+    return embed
+
+def embed_missing_chunks(table_name, endpoint, host, token=None, requests_per_second=4.0, num_partitions=4, **client_kwargs):
+    # embedding이 비어 있는 청크만 계산하므로 변경되지 않은 청크는 다시 임베딩하지 않음
+    # 엔드포인트 할당량(requests_per_second)을 파티션 수로 나누어 모든 Task의 합이 할당량을 넘지 않도록 함
+    if EMBEDDING_COLUMN not in spark.table(table_name).columns:
+        spark.sql(f"ALTER TABLE {table_name} ADD COLUMNS ({EMBEDDING_COLUMN} ARRAY<FLOAT>)")
+    embed = embedding_udf(endpoint, host, token=token, requests_per_second=requests_per_second / num_partitions, **client_kwargs)
+    # MERGE가 원본을 다시 읽더라도 임베딩이 다시 계산되지 않도록 캐시
+    updates = (spark.table(table_name)
+               .where(F.col(EMBEDDING_COLUMN).isNull())
+               .select("id", "content")
+               .repartition(num_partitions)
+               .withColumn(EMBEDDING_COLUMN, embed("content"))
+               .cache())
+    count = updates.count()
+    updates.createOrReplaceTempView("_embedding_updates")
+    spark.sql(f"""
+              MERGE INTO {table_name} t USING _embedding_updates u ON t.id = u.id
+              WHEN MATCHED THEN UPDATE SET t.{EMBEDDING_COLUMN} = u.{EMBEDDING_COLUMN}
+              """)
+    updates.unpersist()
+    return count
@@ -0,0 +1,810 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # PDF 문서 추출 및 전처리를 위한 헬퍼 노트북입니다.
+# MAGIC
+# MAGIC 이 노트북에서는 PDF 추출, 정제, 청킹 단계에서 사용하는 헬퍼 함수들이 포함되어 있습니다.
+# MAGIC
+
+# COMMAND ----------
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pymupdf
+import pymupdf4llm
+
+# COMMAND ----------
+
+# DBTITLE 1,페이지를 나누어 여러 프로세스로 병렬 추출
+def split_pages(pages, num_shards):
+    # 페이지 순서가 유지되도록 연속된 구간으로 균등하게 분할
+    num_shards = max(1, min(num_shards, len(pages)))
+    size, rest = divmod(len(pages), num_shards)
+    shards, start = [], 0
+    for i in range(num_shards):
+        end = start + size + (1 if i < rest else 0)
+        shards.append(pages[start:end])
+        start = end
+    return shards
+
+def _to_markdown_shard(args):
+    doc, pages, hdr_info, kwargs = args
+    return pymupdf4llm.to_markdown(doc=doc, pages=pages, hdr_info=hdr_info, **kwargs)
+
+def to_markdown_parallel(doc, pages=None, max_workers=None, shards_per_worker=2, hdr_info=None, **kwargs):
+    if pages is None:
+        with pymupdf.open(doc) as pdf:
+            pages = list(range(pdf.page_count))
+    pages = list(pages)
+    max_workers = max_workers or os.cpu_count() or 1
+
+    # 헤더 수준(글꼴 크기)은 to_markdown 기본 동작과 같이 문서 전체 기준으로 한 번만 계산하여 모든 샤드에 동일하게 적용
+    if hdr_info is None:
+        hdr_info = pymupdf4llm.IdentifyHeaders(doc)
+
+    shards = split_pages(pages, max_workers * shards_per_worker)
+    if max_workers == 1 or len(shards) == 1:
+        return pymupdf4llm.to_markdown(doc=doc, pages=pages, hdr_info=hdr_info, **kwargs)
+
+    # 노트북에 정의된 함수를 워커에서 사용할 수 있도록 fork 방식으로 프로세스를 생성
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("fork")) as executor:
+        outputs = list(executor.map(_to_markdown_shard, [(doc, shard, hdr_info, kwargs) for shard in shards]))
+
+    # 샤드 결과를 페이지 순서대로 결합. 각 페이지 출력은 '-----' 구분자로 끝나므로 이후의 페이지 분할 로직이 그대로 동작
+    if kwargs.get("page_chunks"):
+        return [page for shard in outputs for page in shard]
+    return "".join(outputs)
+
+# COMMAND ----------
+
+# DBTITLE 1,표가 있는 페이지에만 표 감지를 수행하는 적응형 추출
+from itertools import groupby
+
+def table_rulings(page, tolerance=3.0):
+    # lines_strict 표 감지와 같은 기준으로 괘선을 모음. 채우기 전용 도형은 선처럼 얇을 때만 괘선으로 간주
+    horizontal, vertical = [], []
+
+    def add(p1, p2):
+        if abs(p1.y - p2.y) <= tolerance:
+            horizontal.append((min(p1.x, p2.x), max(p1.x, p2.x), (p1.y + p2.y) / 2))
+        elif abs(p1.x - p2.x) <= tolerance:
+            vertical.append((min(p1.y, p2.y), max(p1.y, p2.y), (p1.x + p2.x) / 2))
+
+    drawings = page.get_drawings()
+    for path in drawings:
+        if path["type"] == "f" and path["rect"].width > tolerance and path["rect"].height > tolerance:
+            continue
+        items = path["items"]
+        for item in items:
+            if item[0] == "l":
+                add(item[1], item[2])
+            elif item[0] == "re":
+                rect = item[1].normalize()
+                add(rect.tl, rect.tr); add(rect.bl, rect.br); add(rect.tl, rect.bl); add(rect.tr, rect.br)
+            elif item[0] == "qu":
+                quad = item[1]
+                add(quad.ul, quad.ur); add(quad.ll, quad.lr); add(quad.ul, quad.ll); add(quad.ur, quad.lr)
+        if path.get("closePath") and items[0][0] == "l" and items[-1][0] == "l":
+            add(items[-1][2], items[0][1])
+    return len(drawings), horizontal, vertical
+
+def count_intersections(horizontal, vertical, tolerance=3.0):
+    # 수평 괘선과 수직 괘선이 교차하는 점의 수. 셀은 네 교차점으로 둘러싸여야 만들어짐
+    return sum(1 for x0, x1, y in horizontal for y0, y1, x in vertical
+               if x0 - tolerance <= x <= x1 + tolerance and y0 - tolerance <= y <= y1 + tolerance)
+
+def classify_pages(doc, pages, min_intersections=4):
+    # 교차하는 괘선으로 셀이 하나도 만들어지지 않는 페이지는 lines_strict 감지 결과가 항상 비므로 텍스트 전용으로 분류
+    pdf = doc if isinstance(doc, pymupdf.Document) else pymupdf.open(doc)
+    page_classes = {}
+    for page in pages:
+        drawings, horizontal, vertical = table_rulings(pdf[page])
+        intersections = count_intersections(horizontal, vertical)
+        page_classes[page] = {"drawings": drawings, "horizontal": len(horizontal), "vertical": len(vertical),
+                              "intersections": intersections, "tables": intersections >= min_intersections}
+    if pdf is not doc:
+        pdf.close()
+    return page_classes
+
+class TextOnlyDocument(pymupdf.Document):
+    # pymupdf4llm에는 표 감지를 끄는 옵션이 없고 table_strategy=None도 기본 "lines" 전략으로 감지하므로,
+    # 이 문서에서 꺼낸 페이지 객체의 find_tables만 빈 결과를 반환하도록 바꿈. pymupdf.Page 클래스는 그대로이므로
+    # 같은 프로세스의 다른 스레드나 fork된 워커의 추출에는 영향이 없음
+    def __getitem__(self, i):
+        page = super().__getitem__(i)
+        page.find_tables = lambda *args, **kwargs: []
+        return page
+
+    @classmethod
+    def reopen(cls, doc):
+        # 경로나 이미 연 문서를 받아 같은 PDF를 다시 엶. 파일이 없는 문서(바이트로 연 문서)만 메모리에서 다시 직렬화
+        if not isinstance(doc, pymupdf.Document):
+            return cls(doc)
+        if doc.name and os.path.exists(doc.name):
+            return cls(doc.name)
+        return cls(doc.name or "document.pdf", stream=doc.tobytes(), filetype="pdf")
+
+def to_markdown_adaptive(doc, pages=None, table_strategy="lines_strict", hdr_info=None, page_classes=None, **kwargs):
+    if pages is None:
+        with pymupdf.open(doc) as pdf:
+            pages = list(range(pdf.page_count))
+    pages = list(pages)
+    if hdr_info is None:
+        hdr_info = pymupdf4llm.IdentifyHeaders(doc)
+    if page_classes is None:
+        page_classes = classify_pages(doc, pages)
+
+    # 분류가 같은 연속된 페이지끼리 묶어 원래 페이지 순서대로 추출하며, 텍스트 전용 페이지는 TextOnlyDocument로 연 문서에서 추출
+    outputs = []
+    text_only_doc = None
+    try:
+        for has_tables, group in groupby(pages, key=lambda page: page_classes[page]["tables"]):
+            group = list(group)
+            if not has_tables and text_only_doc is None:
+                text_only_doc = TextOnlyDocument.reopen(doc)
+            outputs.append(pymupdf4llm.to_markdown(doc=doc if has_tables else text_only_doc, pages=group, hdr_info=hdr_info,
+                                                   table_strategy=table_strategy, **kwargs))
+    finally:
+        if text_only_doc is not None:
+            text_only_doc.close()
+    if kwargs.get("page_chunks"):
+        return [page for output in outputs for page in output]
+    return "".join(outputs)
+
+# COMMAND ----------
+
+# DBTITLE 1,추출한 Markdown을 페이지 단위로 디스크에 캐시
+import hashlib
+import json
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class MarkdownPageCache:
+    # PDF 해시 + 페이지 번호 + 추출 파라미터 + pymupdf4llm 버전을 키로 페이지별 Markdown을 저장
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.name.endswith(".md"))
+
+    def key(self, pdf_hash, page, **kwargs):
+        params = json.dumps({"pdf": pdf_hash, "page": page, "version": pymupdf4llm.__version__, **kwargs}, sort_keys=True, default=str)
+        return hashlib.sha256(params.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.md")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # 최근 사용 시각을 갱신하여 LRU 방식으로 제거되도록 함
+        os.utime(path)
+        self.hits += 1
+        return text
+
+    def put(self, key, text):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+        self.total_bytes += os.path.getsize(path) - old_size
+        self._evict()
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        # 가장 오래전에 사용된 페이지부터 제거
+        entries = sorted((entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".md")), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            size = entry.stat().st_size
+            os.remove(entry.path)
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions, "bytes": self.total_bytes}
+
+def to_markdown_cached(doc, pages, cache, max_workers=1, **kwargs):
+    # 페이지별 텍스트만 캐시하므로 page_chunks는 키에서 제외
+    kwargs.pop("page_chunks", None)
+    pdf_hash = file_sha256(doc)
+    keys = {page: cache.key(pdf_hash, page, **kwargs) for page in pages}
+    page_texts = {page: cache.get(keys[page]) for page in pages}
+
+    # 캐시에 없는 페이지만 추출하여 저장
+    missing_pages = [page for page in pages if page_texts[page] is None]
+    if missing_pages:
+        chunks = to_markdown_parallel(doc, pages=missing_pages, max_workers=max_workers, **{**kwargs, "page_chunks": True})
+        for page, chunk in zip(missing_pages, chunks):
+            page_texts[page] = chunk["text"]
+            cache.put(keys[page], chunk["text"])
+
+    return "".join(page_texts[page] for page in pages)
+
+# COMMAND ----------
+
+# DBTITLE 1,정제 규칙을 선언하고 한 번에 적용하는 텍스트 정규화 엔진
+import re
+
+# 규칙 종류: 정규식 치환(regex), 문자열 치환(replace), 함수 호출(call)
+def regex_rule(pattern, repl, flags=0):
+    return ("regex", re.compile(pattern, flags), repl)
+
+def replace_rule(old, new):
+    return ("replace", old, new)
+
+def call_rule(func):
+    return ("call", func)
+
+def apply_rules(text, rules):
+    for rule in rules:
+        kind = rule[0]
+        if kind == "regex":
+            text = rule[1].sub(rule[2], text)
+        elif kind == "replace":
+            text = text.replace(rule[1], rule[2])
+        else:
+            text = rule[1](text)
+    return text
+
+# COMMAND ----------
+
+# DBTITLE 1,Zero-to-GenAI-Workshop 노트북의 정제 단계를 규칙으로 정의
+_reference_pattern = re.compile(r'\[\d+\)\]')
+
+def cut_footnotes(page):
+    # r'\d+\) .*(\n.*)*'와 동일하게 처음 나오는 '숫자) ' 각주부터 페이지 끝까지를 제거
+    # 정규식은 긴 숫자열에서 시작 위치마다 다시 매칭하여 제곱 시간이 걸리므로, ') '를 앞에서부터 한 번만 찾고
+    # 찾은 위치 앞의 숫자열을 한 번만 거슬러 올라가 선형 시간을 보장
+    index = page.find(') ')
+    while index != -1:
+        start = index
+        while start > 0 and page[start - 1].isdecimal():
+            start -= 1
+        if start < index:
+            return page[:start]
+        index = page.find(') ', index + 2)
+    return page
+
+def remove_page_footnotes(text):
+    # 페이지별로 각주 내용과 본문 내의 각주 참조를 제거한 뒤 페이지 구분자로 다시 결합
+    cleaned_pages = []
+    for page in text.split('-----'):
+        cleaned_page = cut_footnotes(page).strip()
+        cleaned_page = _reference_pattern.sub('', cleaned_page).strip()
+        cleaned_pages.append(cleaned_page)
+    return '\n\n-----\n'.join(cleaned_pages)
+
+NORMALIZATION_RULES = [
+    # 레이아웃 손상으로 발생한 에러 메시지가 포함된 줄 제거
+    # 매칭은 항상 줄의 시작에서 시작하므로 '^'로 고정하여 줄 중간의 모든 위치에서 다시 시도하지 않도록 함
+    regex_rule(r'^.*syntax error.*\n?', '', re.MULTILINE),
+    # 모든 페이지의 각주 제거
+    call_rule(remove_page_footnotes),
+    # '\x01'을 공백으로, '####'을 '#'로, '숫자. '를 '## 숫자. '로, '□'를 '### '로 변경
+    replace_rule('\x01', ' '),
+    replace_rule('####', '#'),
+    regex_rule(r'^(\d+)\. ', r'## \1. ', re.MULTILINE),
+    regex_rule(r'^□', '### ', re.MULTILINE),
+    # 한국 공공기관에서 자주 사용되는 기호를 제거 또는 치환
+    # 한글이 포함된 텍스트에서는 str.translate보다 문자마다 str.replace를 적용하는 편이 빠름
+    replace_rule('ㅇ', '- '),
+    replace_rule('→', ' 에서 '),
+    replace_rule('’', '20'),
+    replace_rule('☞', '- '),
+    *[replace_rule(char, '') for char in '*[]▲「」'],
+    # 괄호 안에 쉼표가 있는 인용 구문 삭제
+    regex_rule(r'\([^()]*,[^()]*\)', ''),
+    # 페이지 구분자, 개행, 이중 공백 삭제
+    replace_rule('-----', ''),
+    replace_rule('\n\n', ''),
+    replace_rule('  ', ' '),
+    # '#' 앞에 개행을 추가하고 'C'와 '#' 사이의 개행이나 공백은 제거
+    regex_rule(r'(#+)', r'\n\n\1'),
+    regex_rule(r'C\s*#', 'C#'),
+    call_rule(str.strip),
+    # '-' 다음에 공백이 아닌 문자가 오는 경우에만 새로운 줄로 분리
+    regex_rule(r'- (?=\S)', '\n\n- '),
+    # '표 숫자' 앞과 그 뒤에 처음 나오는 '|' 앞에 두 번 개행 추가
+    regex_rule(r'(표 \d)', r'\n\n\1'),
+    regex_rule(r'(표 \d.*?)(\|)', r'\1\n\n\2'),
+    # '※'로 시작하는 문장과 그 후에 오는 관련 내용을 제거
+    regex_rule(r'※[^­]*­', '\n', re.DOTALL),
+]
+
+def normalize_markdown(text, rules=NORMALIZATION_RULES):
+    return apply_rules(text, rules)
+
+# COMMAND ----------
+
+# DBTITLE 1,페이지 단위 스트리밍 전처리
+from langchain_text_splitters import MarkdownHeaderTextSplitter
+
+HEADERS_TO_SPLIT_ON = [
+                        ("#", "Header 1"),
+                        ("##", "Header 2"),
+                        ("###", "Header 3")
+                      ]
+
+def iter_markdown_pages(doc, pages=None, hdr_info=None, **kwargs):
+    # page_chunks=True로 한 페이지씩 추출하여 메모리에는 한 페이지만 유지
+    if pages is None:
+        if isinstance(doc, pymupdf.Document):
+            pages = range(doc.page_count)
+        else:
+            with pymupdf.open(doc) as pdf:
+                pages = range(pdf.page_count)
+    if hdr_info is None:
+        hdr_info = pymupdf4llm.IdentifyHeaders(doc)
+    kwargs["page_chunks"] = True
+    for page in pages:
+        for chunk in pymupdf4llm.to_markdown(doc=doc, pages=[page], hdr_info=hdr_info, **kwargs):
+            yield page, chunk["text"]
+
+def iter_normalized_pages(page_texts, rules=NORMALIZATION_RULES):
+    for page, text in page_texts:
+        yield page, apply_rules(text, rules)
+
+def iter_header_chunks(page_texts, source=None, headers_to_split_on=HEADERS_TO_SPLIT_ON):
+    markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on)
+    header_keys = [name for _, name in headers_to_split_on]
+    current_headers = {}
+    for page, text in page_texts:
+        for chunk in markdown_splitter.split_text(text):
+            # 페이지를 넘어 이어지는 섹션은 이전 페이지의 상위 헤더를 이어받음
+            levels = [header_keys.index(key) for key in chunk.metadata if key in header_keys]
+            top_level = min(levels) if levels else len(header_keys)
+            inherited = {key: current_headers[key] for key in header_keys[:top_level] if key in current_headers}
+            chunk.metadata = {**inherited, **chunk.metadata}
+            current_headers = {key: chunk.metadata[key] for key in header_keys if key in chunk.metadata}
+            chunk.metadata["source"] = source
+            chunk.metadata["page"] = page
+            yield chunk
+
+def stream_document_chunks(doc, pages=None, source=None, **kwargs):
+    # 추출, 정제, 헤더 식별, 청킹을 페이지마다 차례로 수행하는 제너레이터 파이프라인
+    if isinstance(doc, (bytes, bytearray)):
+        # 바이트로만 연 문서는 name이 None이 되어 pymupdf4llm이 이미지 파일명을 만들 때 실패하므로 출처를 파일 이름으로 지정
+        with pymupdf.open(source or "document.pdf", stream=doc, filetype="pdf") as pdf:
+            yield from stream_document_chunks(pdf, pages=pages, source=source, **kwargs)
+        return
+    page_texts = iter_markdown_pages(doc, pages=pages, **kwargs)
+    yield from iter_header_chunks(iter_normalized_pages(page_texts), source=source or str(doc))
+
+# COMMAND ----------
+
+# DBTITLE 1,토큰 수 상한을 넘는 청크를 헤더 정보를 유지한 채 다시 분할
+import numpy as np
+from langchain_core.documents import Document
+
+# 문자 종류별 평균 토큰 수. 한글 음절과 한자는 대부분 음절마다, 영문은 약 3~4글자마다 하나의 토큰이 됨
+TOKEN_WEIGHTS = {"hangul": 1.0, "cjk": 1.0, "latin": 0.3, "digit": 0.5, "space": 0.0, "other": 1.0}
+
+def char_token_weights(codes, weights=TOKEN_WEIGHTS):
+    char_weights = np.full(codes.shape, weights["other"], dtype=np.float32)
+    lower = codes | 0x20
+    char_weights[(lower >= ord("a")) & (lower <= ord("z"))] = weights["latin"]
+    char_weights[(codes >= ord("0")) & (codes <= ord("9"))] = weights["digit"]
+    char_weights[(codes >= 0x4E00) & (codes <= 0x9FFF)] = weights["cjk"]
+    char_weights[((codes >= 0xAC00) & (codes <= 0xD7A3)) | ((codes >= 0x1100) & (codes <= 0x11FF)) | ((codes >= 0x3130) & (codes <= 0x318F))] = weights["hangul"]
+    char_weights[(codes == ord(" ")) | (codes == ord("\n")) | (codes == ord("\t")) | (codes == ord("\r"))] = weights["space"]
+    return char_weights
+
+def _text_weights(texts):
+    # 모든 청크를 하나의 코드포인트 배열로 이어 붙여 한 번에 가중치를 계산
+    codes = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32)
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+    return char_token_weights(codes), offsets, lengths
+
+def _token_totals(char_weights, offsets, lengths):
+    # _text_weights의 결과로 텍스트별 토큰 수를 합산
+    totals = np.zeros(len(lengths), dtype=np.float64)
+    nonempty = lengths > 0
+    if nonempty.any():
+        totals[nonempty] = np.add.reduceat(char_weights, offsets[nonempty], dtype=np.float64)
+    return np.ceil(totals).astype(np.int64)
+
+def estimate_tokens(texts):
+    if not texts:
+        return np.zeros(0, dtype=np.int64)
+    return _token_totals(*_text_weights(texts))
+
+def _split_text_by_tokens(text, char_weights, max_tokens, overlap_tokens, separators=("\n", ". ", " ")):
+    prefix = np.concatenate(([0.0], np.cumsum(char_weights, dtype=np.float64)))
+    pieces, begin = [], 0
+    while begin < len(text):
+        limit = int(np.searchsorted(prefix, prefix[begin] + max_tokens, side="right")) - 1
+        if limit >= len(text):
+            pieces.append(text[begin:])
+            break
+        limit = max(limit, begin + 1)
+        # 상한 안에서 가장 뒤에 있는 개행, 문장 끝, 공백 위치에서 자르되, 너무 앞쪽이면 상한 위치에서 자름
+        cut = limit
+        for separator in separators:
+            position = text.rfind(separator, begin, limit)
+            if position > begin + (limit - begin) // 2:
+                cut = position + len(separator)
+                break
+        pieces.append(text[begin:cut])
+        # 다음 조각은 앞 조각의 끝에서 overlap_tokens만큼 겹치도록 시작
+        overlap_begin = int(np.searchsorted(prefix, prefix[cut] - overlap_tokens, side="left"))
+        word_begin = text.find(" ", overlap_begin, cut)
+        if word_begin != -1:
+            overlap_begin = word_begin + 1
+        begin = max(overlap_begin, begin + 1) if overlap_tokens else cut
+    return [piece.strip() for piece in pieces if piece.strip()]
+
+def split_by_token_budget(chunks, max_tokens=1000, overlap_tokens=100):
+    if overlap_tokens * 2 >= max_tokens:
+        raise ValueError(f"overlap_tokens({overlap_tokens})는 max_tokens({max_tokens})의 절반보다 작아야 합니다.")
+    texts = [chunk.page_content for chunk in chunks]
+    if not texts:
+        return []
+    # 가중치는 한 번만 계산하여 토큰 수 합산과 상한을 넘는 청크의 분할에 함께 사용
+    char_weights, offsets, lengths = _text_weights(texts)
+    totals = _token_totals(char_weights, offsets, lengths)
+
+    split_chunks = []
+    for chunk, offset, length, total in zip(chunks, offsets, lengths, totals):
+        if total <= max_tokens:
+            split_chunks.append(chunk)
+            continue
+        for piece in _split_text_by_tokens(chunk.page_content, char_weights[offset:offset + length], max_tokens, overlap_tokens):
+            split_chunks.append(Document(page_content=piece, metadata=dict(chunk.metadata)))
+    return split_chunks
+
+# COMMAND ----------
+
+# DBTITLE 1,임베딩 전에 MinHash/LSH로 유사 중복 청크 제거
+def _shingle_hashes(text, shingle_size, powers):
+    # 공백을 하나로 정규화한 뒤 문자 n-gram(shingle)의 다항식 해시를 벡터 연산으로 계산
+    codes = np.frombuffer(" ".join(text.split()).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if len(codes) < shingle_size:
+        codes = np.concatenate((codes, np.zeros(shingle_size - len(codes), dtype=np.uint64)))
+    windows = np.lib.stride_tricks.sliding_window_view(codes, shingle_size)
+    return np.unique(windows @ powers)
+
+def _lsh_bands(num_perm, threshold):
+    # 유사도가 threshold인 지점에서 후보가 될 확률 (1/b)^(1/r)이 threshold에 가장 가까운 밴드 구성을 선택
+    candidates = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    return min(candidates, key=lambda br: abs((1 / br[0]) ** (1 / br[1]) - threshold))
+
+def minhash_signatures(texts, num_perm=128, shingle_size=5, seed=0):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+    powers = np.array([1_000_003 ** i % 2**64 for i in range(shingle_size - 1, -1, -1)], dtype=np.uint64)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint32)
+    for i, text in enumerate(texts):
+        hashes = _shingle_hashes(text, shingle_size, powers)
+        signatures[i] = ((a[:, None] * hashes[None, :] + b[:, None]) >> np.uint64(32)).min(axis=1)
+    return signatures
+
+def dedup_chunks(chunks, threshold=0.9, num_perm=128, shingle_size=5, seed=0):
+    # Jaccard 유사도가 threshold 이상인 청크 묶음에서 첫 번째 청크만 남기고 나머지를 제거
+    if not chunks:
+        return [], {"chunks": 0, "kept": 0, "dropped": 0, "embedding_calls_saved": 0}
+    signatures = minhash_signatures([chunk.page_content for chunk in chunks], num_perm, shingle_size, seed)
+    bands, rows = _lsh_bands(num_perm, threshold)
+
+    parent = list(range(len(chunks)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # 같은 밴드 버킷에 들어간 청크는 버킷의 첫 청크와만 비교하므로 청크 수에 거의 선형으로 동작
+    for band in range(bands):
+        buckets = {}
+        band_values = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        for i in range(len(chunks)):
+            key = band_values[i].tobytes()
+            first = buckets.setdefault(key, i)
+            if first != i and find(first) != find(i) and (signatures[first] == signatures[i]).mean() >= threshold:
+                parent[max(find(first), find(i))] = min(find(first), find(i))
+
+    kept = [chunk for i, chunk in enumerate(chunks) if find(i) == i]
+    dropped = len(chunks) - len(kept)
+    return kept, {"chunks": len(chunks), "kept": len(kept), "dropped": dropped, "embedding_calls_saved": dropped}
+
+# COMMAND ----------
+
+# DBTITLE 1,청크를 본문과 헤더, 출처, 페이지 컬럼으로 구성된 행으로 변환
+# content에는 임베딩과 프롬프트에 사용할 본문만 저장하고, 헤더와 출처는 필터링에 사용할 수 있도록 별도 컬럼으로 저장
+CHUNK_SCHEMA = "content STRING, header_1 STRING, header_2 STRING, header_3 STRING, source STRING, page INT, chunk_hash STRING"
+CHUNK_COLUMNS = ["content", "header_1", "header_2", "header_3", "source", "page", "chunk_hash"]
+
+def chunk_hash(source, metadata, text):
+    # 내용이 같은 청크는 실행할 때마다 같은 해시를 가지므로 MERGE의 키로 사용
+    header_path = " > ".join(metadata.get(name, "") for _, name in HEADERS_TO_SPLIT_ON)
+    return hashlib.sha256("\x1f".join([source or "", header_path, text]).encode("utf-8")).hexdigest()
+
+def chunk_row(chunk, source=None):
+    source = chunk.metadata.get("source", source)
+    headers = [chunk.metadata.get(name) for _, name in HEADERS_TO_SPLIT_ON]
+    page = chunk.metadata.get("page")
+    return (chunk.page_content, *headers, source, None if page is None else int(page),
+            chunk_hash(source, chunk.metadata, chunk.page_content))
+
+# COMMAND ----------
+
+# DBTITLE 1,대용량 코퍼스를 위한 배열 기반의 압축된 청크 컨테이너
+import pyarrow as pa
+
+class ChunkArray:
+    # 본문은 하나의 연속된 UTF-8 버퍼와 오프셋 배열에, 헤더와 출처는 중복 없이 한 번만 저장(interning)하고
+    # 청크별로는 정수 코드만 컬럼 배열로 보관. 버퍼 구조가 Arrow와 같으므로 복사 없이 Arrow 테이블로 변환됨
+    def __init__(self, text_buffer, offsets, values, header_codes, source_codes, pages, hashes):
+        self.text_buffer = text_buffer
+        self.offsets = offsets
+        self.values = values
+        self.header_codes = header_codes
+        self.source_codes = source_codes
+        self.pages = pages
+        self.hashes = hashes
+
+    @classmethod
+    def from_documents(cls, chunks, source=None):
+        text_buffer, offsets, hashes = bytearray(), [0], bytearray()
+        value_codes, values = {}, []
+        header_codes = [[] for _ in HEADERS_TO_SPLIT_ON]
+        source_codes, pages = [], []
+
+        def intern(value):
+            if value is None:
+                return -1
+            code = value_codes.get(value)
+            if code is None:
+                code = value_codes[value] = len(values)
+                values.append(value)
+            return code
+
+        for chunk in chunks:
+            content, *headers, chunk_source, page, digest = chunk_row(chunk, source)
+            text_buffer += content.encode("utf-8")
+            offsets.append(len(text_buffer))
+            for level, header in enumerate(headers):
+                header_codes[level].append(intern(header))
+            source_codes.append(intern(chunk_source))
+            pages.append(-1 if page is None else page)
+            hashes += digest.encode("ascii")
+
+        return cls(bytes(text_buffer), np.array(offsets, dtype=np.int64), values,
+                   [np.array(codes, dtype=np.int32) for codes in header_codes],
+                   np.array(source_codes, dtype=np.int32), np.array(pages, dtype=np.int32), bytes(hashes))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def text(self, i):
+        return self.text_buffer[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def __getitem__(self, i):
+        # 필요할 때만 Document로 만들어 반환
+        metadata = {name: self.values[codes[i]] for (_, name), codes in zip(HEADERS_TO_SPLIT_ON, self.header_codes) if codes[i] >= 0}
+        if self.source_codes[i] >= 0:
+            metadata["source"] = self.values[self.source_codes[i]]
+        if self.pages[i] >= 0:
+            metadata["page"] = int(self.pages[i])
+        return Document(page_content=self.text(i), metadata=metadata)
+
+    @property
+    def nbytes(self):
+        return (len(self.text_buffer) + self.offsets.nbytes + sum(codes.nbytes for codes in self.header_codes)
+                + self.source_codes.nbytes + self.pages.nbytes + len(self.hashes)
+                + sum(len(value.encode("utf-8")) for value in self.values))
+
+    def _dictionary_column(self, codes, dictionary):
+        return pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes < 0), dictionary)
+
+    def to_arrow(self, decode_dictionaries=False):
+        n = len(self)
+        content = pa.LargeStringArray.from_buffers(n, pa.py_buffer(self.offsets), pa.py_buffer(self.text_buffer))
+        hash_offsets = np.arange(0, (n + 1) * 64, 64, dtype=np.int64)
+        hashes = pa.LargeStringArray.from_buffers(n, pa.py_buffer(hash_offsets), pa.py_buffer(self.hashes))
+        dictionary = pa.array(self.values, type=pa.string())
+        columns = [content, *[self._dictionary_column(codes, dictionary) for codes in self.header_codes],
+                   self._dictionary_column(self.source_codes, dictionary),
+                   pa.array(self.pages, mask=self.pages < 0), hashes]
+        if decode_dictionaries:
+            columns = [column.dictionary_decode() if isinstance(column, pa.DictionaryArray) else column for column in columns]
+        return pa.Table.from_arrays(columns, names=CHUNK_COLUMNS)
+
+    def to_pandas(self):
+        # pandas 기본 dtype의 DataFrame을 반환하며 결측 헤더와 페이지는 NaN. Spark에 넘길 때의 변환은 chunks_to_dataframe에서 수행
+        return self.to_arrow(decode_dictionaries=True).to_pandas()
+
+# COMMAND ----------
+
+# DBTITLE 1,Spark Executor에서 PDF 추출, 정제, 청킹을 분산 처리
+# Executor에서도 pymupdf4llm, langchain 패키지가 필요하므로 클러스터 라이브러리 또는 %pip로 설치해야 합니다.
+import pandas as pd
+
+def read_pdf_files(path, num_partitions=None):
+    # 디렉터리 또는 Volume 하위의 PDF를 binaryFile로 읽어 Executor 수만큼 파티션을 나눔
+    df_files = (spark.read.format("binaryFile")
+                .option("pathGlobFilter", "*.pdf")
+                .option("recursiveFileLookup", "true")
+                .load(path))
+    return df_files.repartition(num_partitions or spark.sparkContext.defaultParallelism)
+
+def extract_pdf_chunks(df_files, **extract_kwargs):
+    # mapInPandas로 각 파티션에서 PDF 바이트를 직접 열어 페이지 단위 스트리밍 파이프라인을 수행
+    def extract_chunks(batches):
+        for batch in batches:
+            rows = []
+            for path, content in zip(batch["path"], batch["content"]):
+                for chunk in stream_document_chunks(content, source=path, **extract_kwargs):
+                    rows.append(chunk_row(chunk))
+            yield pd.DataFrame(rows, columns=CHUNK_COLUMNS)
+
+    return df_files.select("path", "content").mapInPandas(extract_chunks, schema=CHUNK_SCHEMA)
+
+# COMMAND ----------
+
+# DBTITLE 1,청크를 테이블에 쓸 하나의 DataFrame으로 변환
+import pyspark.sql.functions as F
+
+def chunks_to_dataframe(chunks, source=None):
+    # 값을 SQL 문자열로 만들지 않으므로 작은따옴표를 직접 이스케이프할 필요가 없음
+    if isinstance(chunks, ChunkArray):
+        df = chunks.to_pandas()
+        # 결측값이 있을 수 있는 헤더, 출처, 페이지 컬럼만 Document 경로(chunk_row)와 같이 None이 포함된 object 컬럼으로 바꿔
+        # NaN이 문자열로 저장되거나 페이지가 float가 되지 않도록 하며, 본문과 해시 컬럼은 복사하지 않음
+        for column in CHUNK_COLUMNS:
+            if column in ("content", "chunk_hash") or not df[column].hasnans:
+                continue
+            values = df[column].astype("Int64") if column == "page" else df[column]
+            df[column] = values.astype(object).where(values.notna(), None)
+        return spark.createDataFrame(df, CHUNK_SCHEMA)
+    return spark.createDataFrame([chunk_row(chunk, source) for chunk in chunks], CHUNK_SCHEMA)
+
+def _chunk_rows(chunks_df):
+    # id는 IDENTITY 컬럼이 자동으로 생성하고, created_at은 기존 INSERT 문과 같이 UTC+9 기준 시각으로 기록
+    return chunks_df.select(F.from_utc_timestamp(F.current_timestamp(), 'UTC+9').alias("created_at"), *CHUNK_COLUMNS)
+
+# COMMAND ----------
+
+# DBTITLE 1,내용 해시를 키로 MERGE하여 변경된 청크만 반영
+CHUNK_TABLE_COLUMNS = [column.strip() for column in CHUNK_SCHEMA.split(",")] + ["embedding ARRAY<FLOAT>"]
+
+def migrate_chunk_table(table_name):
+    # 이전 버전의 노트북으로 만든 테이블(id, created_at, content)에는 이후 추가된 컬럼이 없어 chunk_hash 기준 MERGE가 실패하므로 컬럼을 추가.
+    # chunk_hash가 없던 행은 content에 LangChain 직렬화 정보가 포함된 이전 형식이고 MERGE 키로 회수할 수 없으므로 삭제하여 다음 MERGE에서 다시 저장
+    existing = set(spark.table(table_name).columns)
+    missing = [column for column in CHUNK_TABLE_COLUMNS if column.split()[0] not in existing]
+    if not missing:
+        return []
+    print(f"{table_name} 테이블에 컬럼을 추가합니다 : {', '.join(missing)}")
+    spark.sql(f"ALTER TABLE {table_name} ADD COLUMNS ({', '.join(missing)})")
+    if "chunk_hash" not in existing:
+        print(f"{table_name} 테이블에서 이전 형식의 청크를 삭제합니다. 다음 MERGE에서 새 형식으로 다시 저장됩니다.")
+        spark.sql(f"DELETE FROM {table_name} WHERE chunk_hash IS NULL")
+    return missing
+
+def upsert_chunks(chunks_df, table_name, sources=None):
+    # 새로운 해시의 청크만 추가하므로 변경되지 않은 청크는 id가 유지되고 Change Data Feed에는 실제 변경분만 기록됨
+    # 두 번의 MERGE에서 같은 청크를 사용하므로 추출이 다시 실행되지 않도록 캐시
+    updates = _chunk_rows(chunks_df.dropDuplicates(["chunk_hash"])).cache()
+    updates.createOrReplaceTempView("_chunk_updates")
+    spark.sql(f"""
+              MERGE INTO {table_name} t USING _chunk_updates u ON t.chunk_hash = u.chunk_hash
+              WHEN NOT MATCHED THEN INSERT (created_at, {", ".join(CHUNK_COLUMNS)})
+              VALUES (u.created_at, {", ".join(f"u.{column}" for column in CHUNK_COLUMNS)})
+              """)
+
+    # 이번에 처리한 문서의 청크 중 더 이상 존재하지 않는 청크를 회수
+    if sources is None:
+        sources = [r["source"] for r in updates.select("source").distinct().collect()]
+    spark.createDataFrame([(s,) for s in sources], "path STRING").createOrReplaceTempView("_chunk_sources")
+    spark.sql(f"""
+              MERGE INTO {table_name} t USING (
+                SELECT c.chunk_hash FROM {table_name} c
+                JOIN _chunk_sources s ON c.source = s.path
+                LEFT ANTI JOIN _chunk_updates u ON c.chunk_hash = u.chunk_hash
+              ) d ON t.chunk_hash = d.chunk_hash
+              WHEN MATCHED THEN DELETE
+              """)
+    updates.unpersist()
+
+# COMMAND ----------
+
+# DBTITLE 1,처리한 파일 목록(manifest)을 기준으로 변경된 PDF만 증분 처리
+def _read_pdf_listing(path):
+    # content 컬럼을 선택하지 않으면 파일 내용을 읽지 않고 경로, 크기, 수정 시각만 가져옴
+    return (spark.read.format("binaryFile")
+            .option("pathGlobFilter", "*.pdf")
+            .option("recursiveFileLookup", "true")
+            .load(path)
+            .select("path", "length", "modificationTime"))
+
+def _delete_by_paths(table_name, key_column, paths):
+    if not paths:
+        return
+    spark.createDataFrame([(p,) for p in paths], "path STRING").createOrReplaceTempView("_ingest_paths")
+    spark.sql(f"""
+              MERGE INTO {table_name} t USING _ingest_paths p ON t.{key_column} = p.path
+              WHEN MATCHED THEN DELETE
+              """)
+
+def ingest_pdfs_incremental(path, target_table, manifest_table, **extract_kwargs):
+    spark.sql(f"""
+              CREATE TABLE IF NOT EXISTS {manifest_table} (
+                path STRING
+                ,length BIGINT
+                ,modification_time TIMESTAMP
+                ,content_hash STRING
+                ,processed_at TIMESTAMP
+              )
+              """)
+    listing = _read_pdf_listing(path)
+    manifest = spark.table(manifest_table)
+
+    # 크기와 수정 시각이 manifest와 다른 파일만 후보로 선정
+    candidates = listing.join(manifest,
+                              (listing.path == manifest.path)
+                              & (listing.length == manifest.length)
+                              & (listing.modificationTime == manifest.modification_time),
+                              "left_anti")
+    candidate_paths = [r["path"] for r in candidates.select("path").collect()]
+    unchanged = listing.count() - len(candidate_paths)
+    deleted_paths = [r["path"] for r in manifest.join(listing, "path", "left_anti").select("path").collect()]
+
+    new_paths, modified_paths, touched_paths = [], [], []
+    if candidate_paths:
+        # 후보 파일만 내용을 읽어 해시를 계산하고, 내용이 같으면 manifest의 수정 시각만 갱신
+        files = (spark.read.format("binaryFile").load(candidate_paths)
+                 .withColumn("content_hash", F.sha2("content", 256))
+                 .cache())
+        known_hashes = {r["path"]: r["content_hash"] for r in manifest.join(files.select("path"), "path", "left_semi").collect()}
+        for r in files.select("path", "content_hash").collect():
+            if r["path"] not in known_hashes:
+                new_paths.append(r["path"])
+            elif known_hashes[r["path"]] != r["content_hash"]:
+                modified_paths.append(r["path"])
+            else:
+                touched_paths.append(r["path"])
+
+        changed_paths = new_paths + modified_paths
+        if changed_paths:
+            # 새로 추출한 청크를 MERGE하여 수정된 파일에서 내용이 그대로인 청크는 유지하고 사라진 청크만 회수
+            changed_files = files.filter(F.col("path").isin(changed_paths))
+            chunks_df = extract_pdf_chunks(changed_files.repartition(min(len(changed_paths), spark.sparkContext.defaultParallelism)), **extract_kwargs)
+            upsert_chunks(chunks_df, target_table, sources=changed_paths)
+
+        files.select("path", "length", F.col("modificationTime").alias("modification_time"), "content_hash",
+                     F.current_timestamp().alias("processed_at")).createOrReplaceTempView("_ingest_manifest_updates")
+        spark.sql(f"""
+                  MERGE INTO {manifest_table} m USING _ingest_manifest_updates u ON m.path = u.path
+                  WHEN MATCHED THEN UPDATE SET *
+                  WHEN NOT MATCHED THEN INSERT *
+                  """)
+        files.unpersist()
+
+    # 삭제된 파일의 청크와 manifest 항목을 회수
+    _delete_by_paths(target_table, "source", deleted_paths)
+    _delete_by_paths(manifest_table, "path", deleted_paths)
+
+    return {"new": len(new_paths), "modified": len(modified_paths), "touched": len(touched_paths), "deleted": len(deleted_paths),
+            "unchanged": unchanged}
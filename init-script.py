@@ -7,6 +7,11 @@
 
 # COMMAND ----------
 
+# DBTITLE 1,엔드포인트 호출 재시도 헬퍼 함수 초기화
+# MAGIC %run ./retry-helpers
+
+# COMMAND ----------
+
 # 만약에 스키마가 없다면 생성합니다.
 spark.sql(f"CREATE SCHEMA IF NOT EXISTS {uc_catalog}.{uc_schema}")
 
@@ -118,45 +123,47 @@ def get_latest_model_version(model_name):
 # DBTITLE 1,endpoint
 import time
 
+# 엔드포인트 조회는 embedding-helpers 노트북의 call_with_retry로 REQUEST_LIMIT_EXCEEDED 발생 시 백오프 후 재시도하고,
+# 준비 상태 확인 간격도 같은 backoff_delay로 점점 늘립니다.
 def endpoint_exists(vsc, vs_endpoint_name):
-  try:
-    return vs_endpoint_name in [e['name'] for e in vsc.list_endpoints().get('endpoints', [])]
-  except Exception as e:
-    #Temp fix for potential REQUEST_LIMIT_EXCEEDED issue
-    if "REQUEST_LIMIT_EXCEEDED" in str(e):
-      print("WARN: couldn't get endpoint status due to REQUEST_LIMIT_EXCEEDED error. The demo will consider it exists")
-      return True
-    else:
-      raise e
+  endpoints = call_with_retry(vs_endpoint_name, vsc.list_endpoints)
+  return vs_endpoint_name in [e['name'] for e in endpoints.get('endpoints', [])]
 
 def wait_for_vs_endpoint_to_be_ready(vsc, vs_endpoint_name):
   for i in range(180):
-    try:
-      endpoint = vsc.get_endpoint(vs_endpoint_name)
-    except Exception as e:
-      #Temp fix for potential REQUEST_LIMIT_EXCEEDED issue
-      if "REQUEST_LIMIT_EXCEEDED" in str(e):
-        print("WARN: couldn't get endpoint status due to REQUEST_LIMIT_EXCEEDED error. Please manually check your endpoint status")
-        return
-      else:
-        raise e
+    endpoint = call_with_retry(vs_endpoint_name, vsc.get_endpoint, vs_endpoint_name)
     status = endpoint.get("endpoint_status", endpoint.get("status"))["state"].upper()
     if "ONLINE" in status:
       return endpoint
     elif "PROVISIONING" in status or i <6:
       if i % 20 == 0: 
         print(f"Waiting for endpoint to be ready, this can take a few min... {endpoint}")
-      time.sleep(10)
+      time.sleep(backoff_delay(i, base_delay=2.0, max_delay=20.0))
     else:
       raise Exception(f'''Error with the endpoint {vs_endpoint_name}. - this shouldn't happen: {endpoint}.\n Please delete it and re-run the previous cell: vsc.delete_endpoint("{vs_endpoint_name}")''')
   raise Exception(f"Timeout, your endpoint isn't ready yet: {vsc.get_endpoint(vs_endpoint_name)}")
 
+def wait_for_model_serving_endpoint_to_be_ready(deploy_client, endpoint_name, timeout=900):
+  # 고정 시간 대기 대신 엔드포인트 상태가 READY가 될 때까지 점점 간격을 늘리며 확인
+  start = time.monotonic()
+  attempt = 0
+  while time.monotonic() - start < timeout:
+    endpoint = call_with_retry(endpoint_name, deploy_client.get_endpoint, endpoint_name)
+    state = endpoint.get("state", {})
+    if state.get("ready") == "READY" and state.get("config_update") != "IN_PROGRESS":
+      return endpoint
+    if state.get("config_update") == "UPDATE_FAILED":
+      raise Exception(f"Error with the serving endpoint {endpoint_name}: {state}")
+    time.sleep(backoff_delay(attempt, base_delay=2.0, max_delay=30.0))
+    attempt += 1
+  raise Exception(f"Timeout, your serving endpoint isn't ready yet: {endpoint_name}")
+
 # COMMAND ----------
 
 # DBTITLE 1,index
 def index_exists(vsc, endpoint_name, index_full_name):
     try:
-        vsc.get_index(endpoint_name, index_full_name).describe()
+        call_with_retry(endpoint_name, lambda: vsc.get_index(endpoint_name, index_full_name).describe())
         return True
     except Exception as e:
         if 'RESOURCE_DOES_NOT_EXIST' not in str(e):
@@ -166,7 +173,7 @@ def index_exists(vsc, endpoint_name, index_full_name):
     
 def wait_for_index_to_be_ready(vsc, vs_endpoint_name, index_name):
   for i in range(180):
-    idx = vsc.get_index(vs_endpoint_name, index_name).describe()
+    idx = call_with_retry(vs_endpoint_name, lambda: vsc.get_index(vs_endpoint_name, index_name).describe())
     index_status = idx.get('status', idx.get('index_status', {}))
     status = index_status.get('detailed_state', index_status.get('status', 'UNKNOWN')).upper()
     url = index_status.get('index_url', index_status.get('url', 'UNKNOWN'))
@@ -177,7 +184,7 @@ def wait_for_index_to_be_ready(vsc, vs_endpoint_name, index_name):
       return
     elif "PROVISIONING" in status:
       if i % 40 == 0: print(f"Waiting for index to be ready, this can take a few min... {index_status} - pipeline url:{url}")
-      time.sleep(10)
+      time.sleep(backoff_delay(i, base_delay=2.0, max_delay=20.0))
     else:
         raise Exception(f'''Error with the index - this shouldn't happen. DLT pipeline might have been killed.\n Please delete it and re-run the previous cell: vsc.delete_index("{index_name}, {vs_endpoint_name}") \nIndex details: {idx}''')
   raise Exception(f"Timeout, your index isn't ready yet: {vsc.get_index(index_name, vs_endpoint_name)}")
@@ -446,3 +453,46 @@ def table_exists(table_name):
     except:
         return False
     return True
+
+# COMMAND ----------
+
+# DBTITLE 1,파이프라인 단계별 수행 시간 및 자원 계측
+import json
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+pipeline_run_id = uuid.uuid4().hex
+pipeline_spans = []
+pipeline_metrics_path = None # 로컬 JSONL 파일로도 기록하려면 경로를 지정
+
+@contextmanager
+def span(stage, **attributes):
+  # with 블록 안에서 record["bytes"], record["items"]를 지정하면 처리한 바이트 수와 항목 수가 함께 기록됩니다.
+  # cpu_sec는 드라이버 프로세스의 CPU 시간이며 Spark Executor와 원격 엔드포인트의 시간은 포함하지 않습니다.
+  record = {"run_id": pipeline_run_id, "stage": stage, "started_at": datetime.now(timezone.utc).isoformat(),
+            "bytes": None, "items": None, "status": "ok", "error": None}
+  wall_start = time.perf_counter()
+  cpu_start = time.process_time()
+  try:
+    yield record
+  except Exception as e:
+    record["status"] = "error"
+    record["error"] = str(e)
+    raise
+  finally:
+    record["wall_sec"] = time.perf_counter() - wall_start
+    record["cpu_sec"] = time.process_time() - cpu_start
+    record["attributes"] = json.dumps(attributes, ensure_ascii=False, default=str)
+    pipeline_spans.append(record)
+    if pipeline_metrics_path:
+      with open(pipeline_metrics_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def write_spans_to_table(table_name):
+  if not pipeline_spans:
+    return
+  columns = ["run_id", "stage", "started_at", "bytes", "items", "status", "error", "wall_sec", "cpu_sec", "attributes"]
+  spans_df = spark.createDataFrame([tuple(record[c] for c in columns) for record in pipeline_spans],
+                                   "run_id STRING, stage STRING, started_at STRING, bytes BIGINT, items BIGINT, status STRING, error STRING, wall_sec DOUBLE, cpu_sec DOUBLE, attributes STRING")
+  spans_df.withColumn("started_at", F.to_timestamp("started_at")).write.mode("append").option("mergeSchema", "true").saveAsTable(table_name)
@@ -0,0 +1,366 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # 검색을 위한 헬퍼 노트북입니다.
+# MAGIC
+# MAGIC 이 노트북에서는 Vector Search 엔드포인트 없이 드라이버나 모델 서빙 컨테이너 안에서 검색하는 로컬 벡터 인덱스와 BM25 하이브리드 검색이 포함되어 있습니다.
+# MAGIC 벡터 양자화와 점수 계산은 embedding-helpers 노트북의 함수를 사용합니다.
+# MAGIC
+
+# COMMAND ----------
+
+import json
+import os
+from typing import Any, List
+import numpy as np
+import pandas as pd
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+# COMMAND ----------
+
+# DBTITLE 1,IVF 방식의 메모리 매핑 로컬 벡터 인덱스와 여러 질의의 일괄 상위 k개 검색
+def _normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+def _assign_lists(vectors, centroids, block_rows=65536):
+    return np.concatenate([np.argmax(vectors[start:start + block_rows] @ centroids.T, axis=1)
+                           for start in range(0, len(vectors), block_rows)])
+
+def _train_centroids(vectors, n_lists, iterations=10, sample_size=50000, seed=0):
+    # 정규화된 벡터에 대해 내적 기준 k-means를 수행하며, 벡터가 많으면 sample_size개만 사용
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _assign_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=n_lists)
+        # 비어 있는 리스트는 이전 중심을 유지
+        centroids[counts > 0] = _normalize_rows(sums[counts > 0])
+    return centroids
+
+def batch_top_k(codes, scales, query_vectors, k=10, block_rows=65536, query_block=1024):
+    # 모든 질의의 상위 k개 (행 위치, 내적)를 한 번에 계산
+    # 벡터는 block_rows개씩 한 번만 복원하고 질의는 query_block개씩 행렬 곱을 수행하므로
+    # 한 번에 필요한 점수 행렬은 query_block x block_rows 크기로 제한됨
+    queries = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+    k = min(k, len(codes))
+    best_positions = np.zeros((len(queries), 0), dtype=np.int64)
+    best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(codes), block_rows):
+        block = dequantize_embeddings(codes[start:start + block_rows], scales[start:start + block_rows])
+        block_k = min(k, len(block))
+        block_positions = np.empty((len(queries), block_k), dtype=np.int64)
+        block_scores = np.empty((len(queries), block_k), dtype=np.float32)
+        for query_start in range(0, len(queries), query_block):
+            scores = queries[query_start:query_start + query_block] @ block.T
+            top = np.argpartition(-scores, block_k - 1, axis=1)[:, :block_k]
+            block_positions[query_start:query_start + query_block] = top + start
+            block_scores[query_start:query_start + query_block] = np.take_along_axis(scores, top, axis=1)
+        # 지금까지의 상위 k개와 이번 블록의 상위 k개 중에서 다시 상위 k개를 선택
+        positions = np.concatenate([best_positions, block_positions], axis=1)
+        scores = np.concatenate([best_scores, block_scores], axis=1)
+        if scores.shape[1] > k:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            positions = np.take_along_axis(positions, top, axis=1)
+            scores = np.take_along_axis(scores, top, axis=1)
+        best_positions, best_scores = positions, scores
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_positions, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+def filter_mask(rows, filters):
+    # Vector Search의 filters와 같은 {"컬럼": 값 또는 값 목록, "컬럼 NOT": 값, "컬럼 <": 값} 형식을 지원하며 모든 조건을 AND로 결합
+    mask = np.ones(len(rows), dtype=bool)
+    for key, value in (filters or {}).items():
+        column, _, operator = key.partition(" ")
+        values = rows[column]
+        if operator in ("", "NOT"):
+            if isinstance(value, (list, tuple, set)):
+                condition = values.isin(value)
+            else:
+                condition = values.isna() if value is None else values == value
+            condition = ~condition if operator == "NOT" else condition
+        elif operator in ("<", "<=", ">", ">="):
+            condition = {"<": values.lt, "<=": values.le, ">": values.gt, ">=": values.ge}[operator](value)
+        else:
+            raise ValueError(f"unsupported filter operator in {key!r}, expected one of NOT, <, <=, >, >=")
+        mask &= condition.to_numpy(dtype=bool)
+    return mask
+
+class LocalVectorIndex:
+    # 디렉터리에 index.json, centroids.npy, codes.npy, scales.npy, offsets.npy, rows.parquet를 저장하며
+    # 벡터는 리스트 순서로 정렬되어 있어 각 리스트는 codes의 연속된 구간(offsets[l]:offsets[l + 1])이 됨
+    # codes와 scales는 메모리 매핑으로 읽으므로 검색한 리스트의 벡터만 메모리에 올라감
+    def __init__(self, directory, embed_query=None):
+        self.directory = directory
+        self.embed_query = embed_query
+        with open(os.path.join(directory, "index.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.centroids = np.load(os.path.join(directory, "centroids.npy"))
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"))
+        self.codes = np.load(os.path.join(directory, "codes.npy"), mmap_mode="r")
+        self.scales = np.load(os.path.join(directory, "scales.npy"), mmap_mode="r")
+        self.rows = pd.read_parquet(os.path.join(directory, "rows.parquet"))
+
+    def __getstate__(self):
+        # 모델 서빙에 등록할 때는 경로와 임베딩 함수만 직렬화하고 로드 시 다시 메모리 매핑
+        return {"directory": self.directory, "embed_query": self.embed_query}
+
+    def __setstate__(self, state):
+        self.__init__(state["directory"], state["embed_query"])
+
+    @classmethod
+    def build(cls, directory, vectors, rows, n_lists=None, dtype="float16", embed_query=None, seed=0):
+        vectors = _normalize_rows(np.asarray(vectors, dtype=np.float32))
+        n_lists = n_lists or max(1, int(np.sqrt(len(vectors))))
+        centroids = _train_centroids(vectors, n_lists, seed=seed)
+        assignments = _assign_lists(vectors, centroids)
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+        codes, scales = quantize_embeddings(vectors[order], dtype)
+
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "centroids.npy"), centroids)
+        np.save(os.path.join(directory, "offsets.npy"), offsets)
+        np.save(os.path.join(directory, "codes.npy"), codes)
+        np.save(os.path.join(directory, "scales.npy"), scales)
+        rows.iloc[order].reset_index(drop=True).to_parquet(os.path.join(directory, "rows.parquet"))
+        with open(os.path.join(directory, "index.json"), "w", encoding="utf-8") as f:
+            json.dump({"count": len(vectors), "dimension": vectors.shape[1], "n_lists": n_lists, "dtype": dtype,
+                       "columns": list(rows.columns)}, f)
+        return cls(directory, embed_query)
+
+    @classmethod
+    def from_table(cls, table_name, directory, embed_documents=None, embedding_column="embedding", **build_kwargs):
+        # 자체 관리 임베딩 모드로 저장한 embedding 컬럼을 사용하고, 컬럼이 없거나 비어 있으면 embed_documents로 계산
+        table = spark.table(table_name)
+        rows = table.drop(embedding_column).toPandas() if embedding_column in table.columns else table.toPandas()
+        vectors = None
+        if embedding_column in table.columns:
+            embeddings = table.select(embedding_column).toPandas()[embedding_column]
+            if embeddings.notna().all():
+                vectors = np.stack(embeddings.to_numpy())
+        if vectors is None:
+            if embed_documents is None:
+                raise ValueError(f"{table_name} has no complete {embedding_column} column, embed_documents is required")
+            vectors = embed_documents(rows["content"].tolist())
+        return cls.build(directory, vectors, rows, **build_kwargs)
+
+    def describe(self):
+        return {"name": self.directory, "index_type": "LOCAL_IVF", **self.meta}
+
+    def search_vectors(self, query_vectors, num_results=10, nprobe=None):
+        # 질의마다 중심과의 내적이 큰 nprobe개의 리스트만 탐색하여 (행 위치, 점수)를 반환
+        # 점수는 Vector Search와 같이 정규화된 벡터의 L2 거리로 1 / (1 + 거리²)를 사용
+        # nprobe를 지정하지 않았고 tune_nprobe로 정한 값도 없으면 recall이 떨어지지 않도록 모든 벡터를 정확히 탐색
+        query_vectors = _normalize_rows(np.atleast_2d(np.asarray(query_vectors, dtype=np.float32)))
+        nprobe = nprobe or self.meta.get("nprobe")
+        if nprobe is None:
+            positions, scores = batch_top_k(self.codes, self.scales, query_vectors, num_results)
+            return [(p, 1 / (1 + (2 - 2 * s))) for p, s in zip(positions, scores)]
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-(query_vectors @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        results = []
+        for query_vector, lists in zip(query_vectors, probes):
+            candidates = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+            scores = score_embeddings(self.codes[candidates], self.scales[candidates], query_vector)[0]
+            k = min(num_results, len(candidates))
+            top = np.argpartition(-scores, k - 1)[:k] if k else np.array([], dtype=int)
+            top = top[np.argsort(-scores[top])]
+            results.append((candidates[top], 1 / (1 + (2 - 2 * scores[top]))))
+        return results
+
+    def tune_nprobe(self, query_vectors, num_results=10, target_recall=0.95):
+        # 정확한 탐색 결과 대비 recall@num_results가 target_recall 이상인 가장 작은 nprobe를 두 배씩 늘려 찾고 index.json에 저장
+        exact = [set(positions) for positions, _ in self.search_vectors(query_vectors, num_results, nprobe=len(self.centroids))]
+        nprobe = 1
+        while True:
+            results = self.search_vectors(query_vectors, num_results, nprobe)
+            recall = np.mean([len(set(positions) & truth) / len(truth) for (positions, _), truth in zip(results, exact)])
+            if recall >= target_recall or nprobe >= len(self.centroids):
+                break
+            nprobe = min(nprobe * 2, len(self.centroids))
+        self.meta["nprobe"] = int(nprobe)
+        with open(os.path.join(self.directory, "index.json"), "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        return nprobe, float(recall)
+
+    def batch_search(self, query_vectors, num_results=10, **batch_kwargs):
+        # 리스트를 나누지 않고 모든 벡터를 정확히 탐색하여 질의별 상위 num_results개의 id와 점수를 반환
+        positions, scores = batch_top_k(self.codes, self.scales, _normalize_rows(np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))),
+                                        num_results, **batch_kwargs)
+        return self.rows["id"].to_numpy()[positions], 1 / (1 + (2 - 2 * scores))
+
+    def similarity_search(self, columns, query_text=None, query_vector=None, filters=None, num_results=10, nprobe=None):
+        # vsc.get_index(...).similarity_search와 같은 응답 형식(manifest, result.data_array 마지막 값이 score)을 반환
+        if query_vector is None:
+            if query_text is None or self.embed_query is None:
+                raise ValueError("query_vector, or query_text with embed_query, is required")
+            query_vector = self.embed_query(query_text)
+        if filters:
+            # 조건을 만족하는 행만 정확히 탐색
+            allowed = np.flatnonzero(filter_mask(self.rows, filters))
+            positions, scores = np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+            if len(allowed):
+                query_vector = _normalize_rows(np.atleast_2d(np.asarray(query_vector, dtype=np.float32)))
+                top, inner = batch_top_k(self.codes[allowed], self.scales[allowed], query_vector, num_results)
+                positions, scores = allowed[top[0]], 1 / (1 + (2 - 2 * inner[0]))
+        else:
+            positions, scores = self.search_vectors(query_vector, num_results, nprobe)[0]
+        values = self.rows.iloc[positions][columns].astype(object).where(lambda df: df.notna(), None).values.tolist()
+        data_array = [[*row, float(score)] for row, score in zip(values, scores)]
+        return {"manifest": {"column_count": len(columns) + 1, "columns": [{"name": column} for column in columns] + [{"name": "score"}]},
+                "result": {"row_count": len(data_array), "data_array": data_array}}
+
+# COMMAND ----------
+
+# DBTITLE 1,로컬 벡터 인덱스를 사용하는 랭체인 리트리버
+def response_to_documents(response, text_column="content"):
+    # similarity_search 응답을 DatabricksVectorSearch와 같이 본문과 메타데이터(score 포함)로 구성된 Document로 변환
+    columns = [column["name"] for column in response["manifest"]["columns"]]
+    documents = []
+    for row in response["result"]["data_array"]:
+        values = dict(zip(columns, row))
+        documents.append(Document(page_content=values.pop(text_column), metadata=values))
+    return documents
+
+class LocalVectorSearchRetriever(BaseRetriever):
+    index: Any
+    text_column: str = "content"
+    columns: List[str] = []
+    k: int = 4
+    filters: dict = {}
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        response = self.index.similarity_search(columns=[self.text_column, *self.columns], query_text=query,
+                                                filters=self.filters, num_results=self.k)
+        return response_to_documents(response, self.text_column)
+
+# COMMAND ----------
+
+# DBTITLE 1,한국어 문자 n-gram 역색인과 BM25 점수
+import re
+from collections import Counter
+
+_WORD_PATTERN = re.compile(r"[가-힣]+|[0-9a-z]+")
+
+def korean_ngrams(text, n=2):
+    # 한글 단어는 형태소 분석 없이 n글자씩 겹쳐 자르고, 영문과 숫자는 단어 그대로 사용
+    # 예) "소프트웨어진흥법 제2조 6" -> 소프, 프트, 트웨, 웨어, 어진, 진흥, 흥법, 제, 2, 조, 6
+    tokens = []
+    for word in _WORD_PATTERN.findall(text.lower()):
+        if len(word) <= n or not "가" <= word[0] <= "힣":
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + n] for i in range(len(word) - n + 1))
+    return tokens
+
+class BM25Index:
+    # 용어별 포스팅(문서 위치)과 BM25 가중치를 용어 순서로 이어 붙인 배열로 저장하므로,
+    # 질의 시에는 질의 용어의 구간을 점수 배열에 더하기만 하면 됨
+    def __init__(self, vocabulary, term_offsets, postings, weights, rows, text_column="content", tokenize=korean_ngrams):
+        self.vocabulary = vocabulary
+        self.term_offsets = term_offsets
+        self.postings = postings
+        self.weights = weights
+        self.rows = rows.reset_index(drop=True)
+        self.text_column = text_column
+        self.tokenize = tokenize
+
+    @classmethod
+    def build(cls, rows, text_column="content", k1=1.2, b=0.75, tokenize=korean_ngrams):
+        term_counts = [Counter(tokenize(text)) for text in rows[text_column]]
+        lengths = np.array([sum(counts.values()) for counts in term_counts], dtype=np.float32)
+        average_length = lengths.mean() if len(lengths) and lengths.mean() > 0 else 1.0
+        vocabulary = {}
+        term_ids, doc_ids, term_frequencies = [], [], []
+        for doc_id, counts in enumerate(term_counts):
+            for term, frequency in counts.items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                doc_ids.append(doc_id)
+                term_frequencies.append(frequency)
+        term_ids = np.array(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind="stable")
+        term_ids = term_ids[order]
+        doc_ids = np.array(doc_ids, dtype=np.int64)[order]
+        term_frequencies = np.array(term_frequencies, dtype=np.float32)[order]
+
+        document_frequencies = np.bincount(term_ids, minlength=len(vocabulary))
+        idf = np.log(1 + (len(term_counts) - document_frequencies + 0.5) / (document_frequencies + 0.5)).astype(np.float32)
+        weights = idf[term_ids] * term_frequencies * (k1 + 1) / (term_frequencies + k1 * (1 - b + b * lengths[doc_ids] / average_length))
+        term_offsets = np.concatenate([[0], np.cumsum(document_frequencies)])
+        return cls(vocabulary, term_offsets, doc_ids, weights.astype(np.float32), rows, text_column, tokenize)
+
+    @classmethod
+    def from_table(cls, table_name, columns=("id", "content", "header_1", "header_2", "header_3", "source", "page"), **build_kwargs):
+        return cls.build(spark.table(table_name).select(*columns).toPandas(), **build_kwargs)
+
+    def search(self, query, num_results=10):
+        # 질의 용어가 하나도 없는 문서는 제외하고 상위 num_results개의 (행 위치, 점수)를 반환
+        scores = np.zeros(len(self.rows), dtype=np.float32)
+        for term, frequency in Counter(self.tokenize(query)).items():
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            # 한 용어의 포스팅에는 같은 문서가 한 번만 있으므로 인덱스 덧셈이 누락 없이 적용됨
+            scores[self.postings[start:end]] += frequency * self.weights[start:end]
+        k = min(num_results, int(np.count_nonzero(scores)))
+        if k == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return top, scores[top]
+
+    def search_documents(self, query, num_results=10):
+        positions, scores = self.search(query, num_results)
+        documents = []
+        for row, score in zip(self.rows.iloc[positions].to_dict("records"), scores):
+            text = row.pop(self.text_column)
+            documents.append(Document(page_content=text, metadata={**row, "score": float(score)}))
+        return documents
+
+# COMMAND ----------
+
+# DBTITLE 1,벡터 검색과 BM25 검색 결과를 RRF로 결합하는 하이브리드 리트리버
+def reciprocal_rank_fusion(rankings, k=60):
+    # 각 순위 목록에서 1 / (k + 순위)를 더해 점수가 높은 순서로 (키, 점수)를 반환
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+def _fusion_key(document, key_column):
+    # Vector Search는 숫자 컬럼을 실수로 반환하므로 BM25 결과의 정수 id와 같은 키가 되도록 변환
+    key = document.metadata.get(key_column)
+    if key is None:
+        return document.page_content
+    if isinstance(key, (float, np.floating)) and float(key).is_integer():
+        return int(key)
+    return key.item() if isinstance(key, np.generic) else key
+
+class HybridRetriever(BaseRetriever):
+    # dense_retriever는 fetch_k개 정도의 후보를 반환하도록 설정한 벡터 검색 리트리버
+    dense_retriever: Any
+    lexical_index: Any
+    k: int = 4
+    fetch_k: int = 20
+    rrf_k: int = 60
+    key_column: str = "id"
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        documents = {}
+        rankings = []
+        for candidates in (self.dense_retriever.invoke(query), self.lexical_index.search_documents(query, self.fetch_k)):
+            ranking = []
+            for document in candidates:
+                key = _fusion_key(document, self.key_column)
+                documents.setdefault(key, document)
+                ranking.append(key)
+            rankings.append(ranking)
+        return [Document(page_content=documents[key].page_content, metadata={**documents[key].metadata, "rrf_score": score})
+                for key, score in reciprocal_rank_fusion(rankings, self.rrf_k)[:self.k]]
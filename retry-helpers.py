@@ -0,0 +1,161 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # 엔드포인트 호출의 재시도를 위한 헬퍼 노트북입니다.
+# MAGIC
+# MAGIC 이 노트북에서는 429 응답과 일시적인 오류에 대한 재시도, 서킷 브레이커, 엔드포인트별 동시 호출 제한이 포함되어 있습니다.
+# MAGIC init-script 노트북의 엔드포인트 대기 함수와 embedding-helpers 노트북의 임베딩 클라이언트가 함께 사용합니다.
+# MAGIC
+
+# COMMAND ----------
+
+import random
+import re
+import threading
+import time
+
+# COMMAND ----------
+
+# DBTITLE 1,429 응답과 일시적인 오류에 대한 재시도, 서킷 브레이커, 엔드포인트별 동시 호출 제한
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+RETRYABLE_ERROR_CODES = {"REQUEST_LIMIT_EXCEEDED", "TEMPORARILY_UNAVAILABLE"}
+
+# 응답 객체를 제공하지 않는 클라이언트는 상태 코드를 예외 메시지에 'status_code 429', 'error code 429', '429 Client Error' 형식으로 남김
+_STATUS_PATTERN = re.compile(r'(?:status(?:[_ ]code)?|error code)\W{0,3}(\d{3})\b|\b(\d{3}) (?:Client|Server) Error')
+_ERROR_CODE_PATTERN = re.compile(r'"error_code"\s*:\s*"([A-Z_]+)"')
+
+class CircuitOpenError(Exception):
+    pass
+
+def error_status(error):
+    for source in (getattr(error, "response", None), error):
+        for attribute in ("status_code", "status"):
+            status = getattr(source, attribute, None)
+            if isinstance(status, int):
+                return status
+    match = _STATUS_PATTERN.search(str(error))
+    return int(match.group(1) or match.group(2)) if match else None
+
+def error_code(error):
+    code = getattr(error, "error_code", None)
+    if isinstance(code, str):
+        return code
+    match = _ERROR_CODE_PATTERN.search(str(error))
+    return match.group(1) if match else None
+
+def is_retryable(error):
+    # 메시지의 임의 위치에 있는 숫자가 아니라 파싱한 HTTP 상태 코드나 에러 코드로만 판단
+    return error_status(error) in RETRYABLE_STATUS or error_code(error) in RETRYABLE_ERROR_CODES
+
+def retry_after_seconds(headers):
+    # Retry-After 헤더는 초 단위 값만 사용하며 없으면 None
+    try:
+        return float(headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=60.0, retry_after=None):
+    # 서버가 알려준 Retry-After를 우선하고, 없으면 지수 백오프 구간에서 무작위로 대기(full jitter)
+    if retry_after is not None:
+        return min(retry_after, max_delay)
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+class EndpointThrottle:
+    # 엔드포인트별로 동시 호출 수를 제한하고, 재시도를 모두 소진한 호출이 failure_threshold번 연속되면
+    # reset_timeout 동안 호출을 차단한 뒤 한 번의 시험 호출로 회복 여부를 확인
+    def __init__(self, name, max_concurrency=4, max_attempts=8, base_delay=1.0, max_delay=60.0, failure_threshold=3, reset_timeout=60.0):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.stats = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0, "wait_sec": 0.0}
+
+    def __getstate__(self):
+        # Spark UDF와 함께 Executor로 직렬화될 때 잠금 객체는 복사할 수 없으므로 설정만 보내고, 호출 상태는 Executor에서 새로 시작
+        return {"name": self.name, "max_concurrency": self.max_concurrency, "max_attempts": self.max_attempts,
+                "base_delay": self.base_delay, "max_delay": self.max_delay, "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is not None:
+                # reset_timeout이 지난 뒤에는 시험 호출 하나만 통과시키고, 그 결과가 나올 때까지 나머지 호출은 계속 차단
+                if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(f"Circuit for {self.name} is open after {self.failures} consecutive failures")
+                self.probing = True
+            self.stats["calls"] += 1
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.stats["failures"] += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release(self):
+        # 재시도 대상이 아닌 오류로 끝난 호출은 회복 여부를 알려주지 않으므로 다음 호출이 시험 호출을 맡도록 함
+        with self.lock:
+            self.probing = False
+
+    def delay(self, attempt, retry_after=None):
+        seconds = backoff_delay(attempt, self.base_delay, self.max_delay, retry_after)
+        with self.lock:
+            self.stats["retries"] += 1
+            self.stats["wait_sec"] += seconds
+        return seconds
+
+    def call(self, func, /, *args, **kwargs):
+        self.before_call()
+        for attempt in range(self.max_attempts):
+            try:
+                with self.semaphore:
+                    result = func(*args, **kwargs)
+                self.record_success()
+                return result
+            except Exception as e:
+                if not is_retryable(e):
+                    self.release()
+                    raise
+                if attempt == self.max_attempts - 1:
+                    self.record_failure()
+                    raise
+                retry_after = retry_after_seconds(getattr(getattr(e, "response", None), "headers", None))
+                time.sleep(self.delay(attempt, retry_after))
+
+endpoint_throttles = {}
+
+def throttle_for(name, **kwargs):
+    # 같은 엔드포인트를 호출하는 모든 셀과 클라이언트가 하나의 제한 상태를 공유
+    if name not in endpoint_throttles:
+        endpoint_throttles[name] = EndpointThrottle(name, **kwargs)
+    return endpoint_throttles[name]
+
+def call_with_retry(name, func, /, *args, **kwargs):
+    return throttle_for(name).call(func, *args, **kwargs)
+
+def create_with_retry(name, func, /, *args, **kwargs):
+    # 생성 요청은 멱등이 아니므로, 응답을 받지 못한 요청이 실제로 처리되어 재시도가 '이미 존재' 오류로 끝나면 생성된 것으로 간주
+    try:
+        return call_with_retry(name, func, *args, **kwargs)
+    except Exception as e:
+        if error_code(e) == "RESOURCE_ALREADY_EXISTS" or "already exists" in str(e).lower():
+            return None
+        raise